@@ -0,0 +1,139 @@
+import asyncio
+from socketr import *
+from pool import ConnectionClosed
+from httpclient import HTTPClient, HTTPResponse, IDEMPOTENT_METHODS
+from decoder import MAX_DECODED_SIZE
+
+class AsyncHTTPClient(object):
+    '''asyncio counterpart of HTTPClient, so one event loop can drive many requests at once.
+
+    max_concurrency bounds the requests in flight through this client, max_idle the
+    persistent connections kept per (host, port), and limit the longest header block read.
+    '''
+
+    def __init__(self, max_concurrency: int = 100, max_idle: int = 4, limit: int = 2 ** 16,
+                 decode_content: bool = True, max_decoded_size: int = MAX_DECODED_SIZE):
+        self.decode_content = decode_content
+        self.max_decoded_size = max_decoded_size
+        self.max_concurrency = max_concurrency
+        self.max_idle = max_idle
+        self.limit = limit
+        #Created on first use so it binds to the running loop
+        self._semaphore = None
+        self._idle = {}
+        self.serializer = RequestSerializer()
+
+    get_host_port = HTTPClient.get_host_port
+    content_decoder = HTTPClient.content_decoder
+    decode = HTTPClient.decode
+    _head_fields = staticmethod(HTTPClient._head_fields)
+
+    async def connect(self, host, port) -> tuple:
+        '''Opens (reader, writer) over TCP, or over a Unix domain socket for http+unix urls (port None).'''
+        if port is None:
+            return await asyncio.open_unix_connection(host, limit = self.limit)
+        return await asyncio.open_connection(host, port, limit = self.limit)
+
+    def close(self):
+        '''Closes every idle pooled connection.'''
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for reader, writer in conns:
+                writer.close()
+
+    async def recvall(self, reader: asyncio.StreamReader, method: str) -> tuple:
+        '''Reads exactly one response with the same parser as HTTPClient.recvall.
+        Returns the head, the body and whether the connection can carry another request.'''
+        parser = ResponseParser(method, self.limit)
+        head = None
+        body = bytearray()
+        while not parser.done:
+            try:
+                data = await reader.read(self.limit)
+            except ConnectionResetError:
+                if parser.started:
+                    raise
+                data = b''
+            events = parser.feed(data) if data else parser.feed_eof()
+            if not data and not events and not parser.done:
+                raise ConnectionClosed('Connection closed without responding')
+            for event in events:
+                if type(event) is BodyData:
+                    body += event.data
+                elif type(event) is HeadersComplete:
+                    head = event.head
+        #Bytes after the response can't be handed back to the reader, so the connection is done
+        return (head, body, parser.reusable and not parser.unconsumed)
+
+    def _acquire_idle(self, key: tuple):
+        '''Returns a live idle (reader, writer) pair for key, closing any dead ones.'''
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return (reader, writer)
+            writer.close()
+        return None
+
+    def _release(self, key: tuple, reader, writer, reusable: bool):
+        idle = self._idle.setdefault(key, [])
+        if reusable and len(idle) < self.max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def communicate_r(self, host, port, data: Request) -> HTTPResponse:
+        '''Sends a request on a pooled connection and returns the response.
+        A reused connection found dead before answering is discarded and the request retried on another.'''
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        #Kept as separate buffers, which asyncio (3.12+) writes with one sendmsg; it already sets TCP_NODELAY itself
+        payload = (data.head_bytes(), data.body.encode('utf-8'))
+        method = data.get('Method')
+        key = (host, port)
+
+        async with self._semaphore:
+            while True:
+                conn = self._acquire_idle(key)
+                reused = conn is not None
+                reader, writer = conn if reused else await self.connect(host, port)
+                sent = False
+                try:
+                    writer.writelines(payload)
+                    await writer.drain()
+                    sent = True
+                    head, body, reusable = await self.recvall(reader, method)
+                except ConnectionClosed:
+                    writer.close()
+                    if reused and method in IDEMPOTENT_METHODS:
+                        continue
+                    raise
+                except (BrokenPipeError, ConnectionResetError):
+                    writer.close()
+                    if reused and not sent:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                self._release(key, reader, writer, reusable)
+                #Some bytes (i.e continuation) cannot be read with utf-8
+                body = self.decode(head, body)
+                return HTTPResponse.from_head(head.decode('ISO-8859-1'), body.decode('ISO-8859-1'))
+
+    async def GET(self, url: str, args = None) -> HTTPResponse:
+        request = self.serializer.build("Get", url, args)
+        host, port = self.get_host_port(request.get("Host"))
+        return await self.communicate_r(host, port, request)
+
+    async def POST(self, url: str, args = None) -> HTTPResponse:
+        request = self.serializer.build("POST", url, args)
+        host, port = self.get_host_port(request.get("Host"))
+        return await self.communicate_r(host, port, request)
+
+    async def command(self, command: str, url: str, args: list):
+        if (command == "POST"):
+            return await self.POST(url, args)
+        else:
+            return await self.GET(url, args)
@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Local benchmarks for the clients, run against in-process servers
+# run python benchmark.py [-n REQUESTS] [-c CONCURRENCY]
+# or  python benchmark.py --suite [-o results.json] [--baseline previous.json]
+# or  python benchmark.py --upload [--sizes BYTES ...]
+# or  python benchmark.py --transports [-n REQUESTS] [--sizes BYTES ...]
+# or  python benchmark.py --send [-n REQUESTS] [--sizes BYTES ...]
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import freetests
+import httpclient
+import asyncclient
+from loadgen import percentile
+from headers import StdHeader
+from socketr import Response
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, peak RSS is then left out
+    resource = None
+
+BENCHPORT = freetests.BASEPORT + 2
+ASYNCPORT = freetests.BASEPORT + 3
+
+#Shared response payload, sliced to the size a request asks for
+PAYLOAD = bytes(range(256)) * (64 * 1024)
+
+#Response header blocks as sent by common servers, parsed alongside google_teapot.txt
+HEADER_BLOCKS = [
+    'HTTP/1.1 200 OK\r\n'
+    'Server: nginx/1.18.0 (Ubuntu)\r\n'
+    'Date: Tue, 07 Feb 2023 10:15:02 GMT\r\n'
+    'Content-Type: text/html\r\n'
+    'Content-Length: 612\r\n'
+    'Last-Modified: Tue, 21 Apr 2020 14:09:01 GMT\r\n'
+    'Connection: keep-alive\r\n'
+    'ETag: "5e9efe7d-264"\r\n'
+    'Accept-Ranges: bytes\r\n\r\n',
+
+    'HTTP/1.1 200 OK\r\n'
+    'Date: Tue, 07 Feb 2023 10:15:03 GMT\r\n'
+    'Content-Type: application/json; charset=utf-8\r\n'
+    'Transfer-Encoding: chunked\r\n'
+    'Connection: keep-alive\r\n'
+    'Cache-Control: private, max-age=0, must-revalidate\r\n'
+    'Set-Cookie: session=8f1c2a9d0e; Path=/; HttpOnly; Secure; SameSite=Lax\r\n'
+    'Set-Cookie: csrftoken=Qm9vQXBwVG9rZW4; Path=/; Secure\r\n'
+    'Vary: Accept-Encoding, Origin\r\n'
+    'X-Request-Id: 4b7c0f3e-8d2a-4c61-9f0b-2e5d7a1c9b33\r\n'
+    'X-Content-Type-Options: nosniff\r\n'
+    'Content-Encoding: gzip\r\n\r\n',
+
+    'HTTP/1.1 304 Not Modified\r\n'
+    'Date: Tue, 07 Feb 2023 10:15:04 GMT\r\n'
+    'Connection: keep-alive\r\n'
+    'ETag: W/"a1b2c3"\r\n'
+    'Cache-Control: public, max-age=31536000, immutable\r\n'
+    'Age: 5312\r\n'
+    'Via: 1.1 varnish\r\n'
+    'X-Served-By: cache-yyz4535-YYZ\r\n'
+    'X-Cache: HIT\r\n'
+    'X-Cache-Hits: 17\r\n\r\n',
+]
+
+def header_corpus() -> list:
+    '''Real header blocks as received off the wire, google_teapot.txt among them.'''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'google_teapot.txt')
+    with open(path, encoding = 'utf-8', newline = '') as f:
+        teapot = f.read()
+    head = teapot[:teapot.index('\r\n\r\n') + 4]
+    if not head.startswith('HTTP/'):
+        #The capture starts at the status code
+        head = 'HTTP/1.1 ' + head
+    return [block.encode('ISO-8859-1') for block in [head] + HEADER_BLOCKS]
+
+def sized_response(path: str) -> bytes:
+    '''Body for a GET: /size/N asks for N bytes, anything else echoes the path.'''
+    if path.startswith('/size/'):
+        return PAYLOAD[:int(path[len('/size/'):])]
+    return bytes(f'{path}\n', 'utf-8')
+
+class QuietHandler(freetests.KeepAliveHTTPHandler):
+    '''The keep-alive harness handler without per-request logging.'''
+    #Headers and body go out in separate writes, which Nagle would hold for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = sized_response(self.path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+#Pending connections the servers queue, well above any concurrency benchmarked, since a connect
+#dropped from a full backlog is only retried a second later and would swamp the measurement
+LISTEN_BACKLOG = 1024
+
+class BenchHTTPServer(freetests.ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+
+def start_server(port = BENCHPORT):
+    '''Starts the threaded http.server variant in a daemon thread.'''
+    httpd = BenchHTTPServer((freetests.BASEHOST, port), QuietHandler)
+    threading.Thread(target = httpd.serve_forever, daemon = True).start()
+    return httpd
+
+class AsyncBenchServer(object):
+    '''Minimal keep-alive HTTP/1.1 server on asyncio streams, for a higher ceiling than http.server.
+    Serves the same routes as QuietHandler, over TCP or, given a path, a Unix domain socket.'''
+
+    def __init__(self, host = freetests.BASEHOST, port = ASYNCPORT, path: str = None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(target = self._run, args = (ready,), daemon = True).start()
+        ready.wait()
+
+    def _run(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        if self.path is not None:
+            start = asyncio.start_unix_server(self.handle, self.path, backlog = LISTEN_BACKLOG)
+        else:
+            start = asyncio.start_server(self.handle, self.host, self.port, backlog = LISTEN_BACKLOG)
+        self.server = self.loop.run_until_complete(start)
+        ready.set()
+        self.loop.run_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.split(b'\r\n')
+                method, path, version = lines[0].split(b' ')
+                length = 0
+                chunked = False
+                expect = False
+                for line in lines[1:]:
+                    if line[:15].lower() == b'content-length:':
+                        length = int(line[15:])
+                    elif line[:18].lower() == b'transfer-encoding:':
+                        chunked = b'chunked' in line.lower()
+                    elif line[:7].lower() == b'expect:':
+                        expect = b'100-continue' in line.lower()
+                #A client waiting for the go-ahead would otherwise sit out its continue timeout
+                if expect:
+                    writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                if chunked:
+                    while True:
+                        size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+                        await reader.readexactly(size + 2)
+                        if not size:
+                            break
+                #Drained in pieces, a large upload need not be held whole
+                while length:
+                    length -= len(await reader.readexactly(min(length, 64 * 1024)))
+                body = sized_response(path.decode('ISO-8859-1')) if method == b'GET' else b''
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+def bench_sync(url: str, requests: int) -> float:
+    '''Issues requests GETs one after another, returns requests/sec.'''
+    client = httpclient.HTTPClient()
+    start = time.perf_counter()
+    for i in range(requests):
+        client.GET(f'{url}/{i}')
+    elapsed = time.perf_counter() - start
+    client.close()
+    return requests / elapsed
+
+def bench_async(url: str, requests: int, concurrency: int) -> float:
+    '''Issues requests GETs from one event loop, concurrency at a time, returns requests/sec.'''
+    client = asyncclient.AsyncHTTPClient(max_concurrency = concurrency, max_idle = concurrency)
+
+    async def run():
+        await asyncio.gather(*(client.GET(f'{url}/{i}') for i in range(requests)))
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        loop.run_until_complete(run())
+        elapsed = time.perf_counter() - start
+        client.close()
+    finally:
+        loop.close()
+    return requests / elapsed
+
+def bench_build(requests: int) -> tuple:
+    '''Builds and serializes requests POSTs without sending them.
+    Returns requests/sec for Request.from_args and for RequestSerializer.'''
+    url = 'http://example.com:8080/a/b'
+    args = {'a': 'aaaa', 'b': 'bbbb'}
+
+    start = time.perf_counter()
+    for i in range(requests):
+        str(httpclient.Request.from_args('POST', url, args)).encode('utf-8')
+    from_args = requests / (time.perf_counter() - start)
+
+    serializer = httpclient.RequestSerializer()
+    start = time.perf_counter()
+    for i in range(requests):
+        request = serializer.build('POST', url, args)
+        request.head_bytes() + request.body.encode('utf-8')
+    serialized = requests / (time.perf_counter() - start)
+
+    return (from_args, serialized)
+
+def bench_headers(rounds: int) -> dict:
+    '''Parses the header corpus rounds times, eagerly and lazily. Returns responses/sec for each
+    way of reading the headers, the memory (bytes) each kind of response keeps, and that of a StdHeader.'''
+    corpus = header_corpus()
+    readers = {
+        'eager': lambda head: Response.from_lines(head.decode('ISO-8859-1')[:-4].split('\r\n'), '').get('Code'),
+        'lazy_status': lambda head: Response.from_head(head.decode('ISO-8859-1'), '').get('Code'),
+        'lazy_field': lambda head: Response.from_head(head.decode('ISO-8859-1'), '').get('Content-Type'),
+    }
+    results = {}
+    for name, read in readers.items():
+        start = time.perf_counter()
+        for i in range(rounds):
+            for head in corpus:
+                read(head)
+        results[name] = rounds * len(corpus) / (time.perf_counter() - start)
+
+    def held(build) -> float:
+        tracemalloc.start()
+        kept = [build(head) for i in range(rounds) for head in corpus]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / len(kept)
+
+    results['eager_bytes'] = held(lambda head: Response.from_lines(head.decode('ISO-8859-1')[:-4].split('\r\n'), ''))
+    results['lazy_bytes'] = held(lambda head: Response.from_head(head.decode('ISO-8859-1'), ''))
+    field, value = 'Content-Type', 'text/html'
+    results['std_header_bytes'] = held(lambda head: StdHeader(field, value))
+    return results
+
+def run_load(url: str, method: str, body_size: int, concurrency: int, requests: int) -> dict:
+    '''Drives one HTTPClient from concurrency threads and measures the requests it completes.'''
+    client = httpclient.HTTPClient(max_per_host = concurrency, max_idle = concurrency)
+    body = PAYLOAD[:body_size]
+    target = f'{url}/size/{body_size}'
+    latencies = []
+    transferred = [0]
+    errors = [0]
+
+    def worker(count: int):
+        for i in range(count):
+            start = time.perf_counter()
+            try:
+                if method == 'POST':
+                    response = client.POST(target, body = body)
+                else:
+                    response = client.GET(target)
+            except Exception:
+                errors[0] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if response.code != 200:
+                errors[0] += 1
+            transferred[0] += body_size
+
+    shares = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, shares))
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'bytes_per_sec': transferred[0] / elapsed,
+        #KiB on Linux, bytes on macOS
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+    }
+
+def _load_process(queue, *args):
+    queue.put(run_load(*args))
+
+def measure(url: str, method: str, body_size: int, concurrency: int, requests: int) -> dict:
+    '''Runs run_load in a fresh process, so its peak RSS and CPU are the client's alone.'''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target = _load_process,
+                                      args = (queue, url, method, body_size, concurrency, requests))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+#How an upload body is handed to POST: a str, a file sent with sendfile, or 64 KiB blocks read from it
+UPLOAD_MODES = ('str', 'sendfile', 'blocks')
+
+def run_upload(url: str, mode: str, size: int, rounds: int) -> dict:
+    '''POSTs a size byte body rounds times as mode says. Returns the MiB/s achieved and the client's
+    CPU seconds per MiB sent.'''
+    #Blocks of unknown length never wait on Expect: 100-continue, so no mode does
+    client = httpclient.HTTPClient(expect_continue = None)
+    with tempfile.NamedTemporaryFile() as f:
+        while f.tell() < size:
+            f.write(PAYLOAD[:size - f.tell()])
+        f.flush()
+        text = 'x' * size if mode == 'str' else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        for i in range(rounds):
+            if mode == 'str':
+                client.POST(url, body = text)
+            elif mode == 'sendfile':
+                client.POST(url, file = f.name)
+            else:
+                with open(f.name, 'rb') as blocks:
+                    client.POST(url, body = iter(lambda: blocks.read(64 * 1024), b''))
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    client.close()
+    mib = size * rounds / 2 ** 20
+    return {'mib_per_sec': mib / wall, 'cpu_per_mib': cpu / mib}
+
+def _upload_process(queue, *args):
+    queue.put(run_upload(*args))
+
+def bench_upload(sizes: list, rounds: int) -> list:
+    '''Measures each upload mode per body size, the client in its own process so its CPU time is its own.'''
+    server = AsyncBenchServer()
+    url = f'http://{freetests.BASEHOST}:{ASYNCPORT}/upload'
+    results = []
+    try:
+        for size in sizes:
+            for mode in UPLOAD_MODES:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target = _upload_process, args = (queue, url, mode, size, rounds))
+                process.start()
+                result = queue.get()
+                process.join()
+                result.update({'mode': mode, 'body_size': size})
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def bench_transports(requests: int, sizes: list) -> list:
+    '''Sends requests serial GETs per body size to the same asyncio server over TCP and over a
+    Unix domain socket, to compare the latency each transport adds.'''
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.sock')
+    servers = {
+        'tcp': (AsyncBenchServer(), f'http://{freetests.BASEHOST}:{ASYNCPORT}'),
+        'unix': (AsyncBenchServer(path = path), 'http+unix://' + urllib.parse.quote(path, safe = '')),
+    }
+    results = []
+    try:
+        for size in sizes:
+            for name, (server, url) in servers.items():
+                result = measure(url, 'GET', size, 1, requests)
+                result.update({'transport': name, 'body_size': size})
+                results.append(result)
+    finally:
+        for server, url in servers.values():
+            server.shutdown()
+            server.server_close()
+        os.rmdir(directory)
+    return results
+
+#How a bytes body goes out: joined onto its head in one copy, written after its head with Nagle's
+#algorithm on (as before vectored sends), or in one gather write with TCP_NODELAY (what the client does)
+SEND_MODES = ('joined', 'separate', 'vectored')
+
+class NagleTransport(httpclient.TCPTransport):
+    def connect(self, *args, **kwargs):
+        sock = super().connect(*args, **kwargs)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+        return sock
+
+class SendModeClient(httpclient.HTTPClient):
+    '''HTTPClient sending bytes bodies the way mode says.'''
+
+    def __init__(self, mode: str):
+        #The body goes out right behind its head, without waiting on Expect: 100-continue
+        super().__init__(transport = NagleTransport() if mode != 'vectored' else None, expect_continue = None)
+        self.mode = mode
+
+    def send_request(self, conn, request, with_head: bool = True):
+        #Without with_head the head already went out ahead of the body, with Expect: 100-continue
+        head = request.head_bytes() if with_head else b''
+        if self.mode == 'joined':
+            self.sendall(conn, head + request.body)
+        elif self.mode == 'separate':
+            if head:
+                self.sendall(conn, head)
+            self.sendall(conn, request.body)
+        else:
+            super().send_request(conn, request, with_head)
+
+def run_send(url: str, mode: str, size: int, requests: int) -> dict:
+    '''POSTs a size byte body requests times, serially, sent as mode says. Returns the median latency,
+    the MiB/s achieved and the client's CPU seconds per MiB sent.'''
+    client = SendModeClient(mode)
+    body = (PAYLOAD * (size // len(PAYLOAD) + 1))[:size]
+    latencies = []
+    wall, cpu = time.perf_counter(), time.process_time()
+    for i in range(requests):
+        start = time.perf_counter()
+        client.POST(url, body = body)
+        latencies.append(time.perf_counter() - start)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    client.close()
+    latencies.sort()
+    mib = max(size, 1) * requests / 2 ** 20
+    return {'p50_ms': percentile(latencies, 0.50) * 1000, 'mib_per_sec': mib / wall, 'cpu_per_mib': cpu / mib}
+
+def _send_process(queue, *args):
+    queue.put(run_send(*args))
+
+def bench_send(requests: int, sizes: list) -> list:
+    '''Measures each send mode per body size against the asyncio server, the client in its own process.
+    Large bodies get fewer requests, about 256 MiB in total.'''
+    server = AsyncBenchServer()
+    url = f'http://{freetests.BASEHOST}:{ASYNCPORT}/upload'
+    results = []
+    try:
+        for size in sizes:
+            count = max(1, min(requests, 256 * 2 ** 20 // max(size, 1)))
+            for mode in SEND_MODES:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target = _send_process, args = (queue, url, mode, size, count))
+                process.start()
+                result = queue.get()
+                process.join()
+                result.update({'mode': mode, 'body_size': size, 'requests': count})
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def run_suite(requests: int, sizes: list, concurrencies: list) -> dict:
+    '''Measures GET and POST across body sizes and concurrency levels against both servers.'''
+    servers = {
+        'threaded': (start_server(), BENCHPORT),
+        'asyncio': (AsyncBenchServer(), ASYNCPORT),
+    }
+    results = []
+    try:
+        for name, (server, port) in servers.items():
+            url = f'http://{freetests.BASEHOST}:{port}'
+            for method in ('GET', 'POST'):
+                for size in sizes:
+                    for concurrency in concurrencies:
+                        #Large bodies get fewer requests so each scenario moves a similar volume
+                        count = max(concurrency, min(requests, (256 * 1024 * 1024) // max(size, 1)))
+                        result = measure(url, method, size, concurrency, count)
+                        result.update({'server': name, 'method': method, 'body_size': size,
+                                       'concurrency': concurrency})
+                        results.append(result)
+                        print(f'{name:9} {method:4} {size:>9} B  c={concurrency:<3} '
+                              f'{result["requests_per_sec"]:9.1f} req/s  p50 {result["p50_ms"]:7.2f} ms  '
+                              f'p99 {result["p99_ms"]:7.2f} ms  {result["bytes_per_sec"] / 2 ** 20:8.1f} MiB/s  '
+                              f'rss {result["peak_rss"]}')
+    finally:
+        for server, port in servers.values():
+            server.shutdown()
+            server.server_close()
+
+    return {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()},
+        'results': results,
+    }
+
+def scenario_key(result: dict) -> tuple:
+    return (result['server'], result['method'], result['body_size'], result['concurrency'])
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.10) -> list:
+    '''Returns a line per scenario whose throughput dropped by more than tolerance since baseline.'''
+    previous = {scenario_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous.get(scenario_key(result))
+        if before is None or not before['requests_per_sec']:
+            continue
+        ratio = result['requests_per_sec'] / before['requests_per_sec']
+        if ratio < 1 - tolerance:
+            regressions.append(f'{scenario_key(result)}: {before["requests_per_sec"]:.1f} -> '
+                               f'{result["requests_per_sec"]:.1f} req/s ({ratio:.0%})')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark HTTPClient and AsyncHTTPClient locally.')
+    parser.add_argument('-n', '--requests', type = int, default = 2000)
+    parser.add_argument('-c', '--concurrency', type = int, default = 50)
+    parser.add_argument('--suite', action = 'store_true', help = 'run the full scenario matrix')
+    parser.add_argument('--headers', action = 'store_true', help = 'only run the header parsing benchmark')
+    parser.add_argument('--upload', action = 'store_true', help = 'only run the upload benchmark, over --sizes')
+    parser.add_argument('--transports', action = 'store_true',
+                        help = 'only compare TCP and Unix domain socket latency, over --sizes')
+    parser.add_argument('--send', action = 'store_true',
+                        help = 'only compare joined, separate and vectored sends of POST bodies, over --sizes')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [0, 16 * 1024, 1024 * 1024])
+    parser.add_argument('--concurrencies', type = int, nargs = '+', default = [1, 8])
+    parser.add_argument('-o', '--output', help = 'write suite results to this JSON file')
+    parser.add_argument('--baseline', help = 'JSON results of an earlier suite run to check for regressions')
+    parser.add_argument('--tolerance', type = float, default = 0.10,
+                        help = 'fractional throughput drop against the baseline reported as a regression')
+    opts = parser.parse_args()
+
+    if opts.suite:
+        results = run_suite(opts.requests, opts.sizes, opts.concurrencies)
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                json.dump(results, f, indent = 2)
+        if opts.baseline:
+            with open(opts.baseline) as f:
+                regressions = compare(json.load(f), results, opts.tolerance)
+            for line in regressions:
+                print(f'REGRESSION {line}')
+            return 1 if regressions else 0
+        return 0
+
+    if opts.upload:
+        for result in bench_upload([size for size in opts.sizes if size], max(1, opts.requests // 100)):
+            print(f'POST {result["mode"]:8} {result["body_size"]:>10} B  {result["mib_per_sec"]:8.1f} MiB/s  '
+                  f'{result["cpu_per_mib"] * 1000:7.3f} ms CPU/MiB')
+        return 0
+
+    if opts.transports:
+        for result in bench_transports(opts.requests, opts.sizes):
+            print(f'GET {result["transport"]:4} {result["body_size"]:>10} B  {result["requests_per_sec"]:9.1f} req/s  '
+                  f'p50 {result["p50_ms"] * 1000:7.1f} us  p99 {result["p99_ms"] * 1000:7.1f} us')
+        return 0
+
+    if opts.send:
+        for result in bench_send(opts.requests, opts.sizes):
+            print(f'POST {result["mode"]:8} {result["body_size"]:>10} B  p50 {result["p50_ms"] * 1000:9.1f} us  '
+                  f'{result["mib_per_sec"]:8.1f} MiB/s  {result["cpu_per_mib"] * 1000:7.3f} ms CPU/MiB')
+        return 0
+
+    headers = bench_headers(opts.requests)
+    print(f'Header parse, eager:            {headers["eager"]:10.1f} resp/s')
+    print(f'Header parse, lazy status only: {headers["lazy_status"]:10.1f} resp/s')
+    print(f'Header parse, lazy one field:   {headers["lazy_field"]:10.1f} resp/s')
+    print(f'Held per response:              {headers["eager_bytes"]:10.1f} B eager, '
+          f'{headers["lazy_bytes"]:.1f} B lazy (unparsed)')
+    print(f'Held per StdHeader:             {headers["std_header_bytes"]:10.1f} B')
+    if opts.headers:
+        return 0
+
+    from_args, serialized = bench_build(opts.requests * 10)
+    print(f'Request.from_args build:        {from_args:10.1f} req/s')
+    print(f'RequestSerializer build:        {serialized:10.1f} req/s')
+
+    httpd = start_server()
+    url = f'http://{freetests.BASEHOST}:{BENCHPORT}/bench'
+    try:
+        print(f'HTTPClient (serial):            {bench_sync(url, opts.requests):10.1f} req/s')
+        print(f'AsyncHTTPClient (c={opts.concurrency:<4}):      {bench_async(url, opts.requests, opts.concurrency):10.1f} req/s')
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
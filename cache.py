@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from socketr import Request, Response
+from headers import StdHeader
+
+#Status codes cacheable by default (RFC 7231 6.1)
+CACHEABLE_CODES = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+
+def parse_cache_control(value: str) -> dict:
+    '''Splits a Cache-Control value into directive -> argument (None for bare directives).'''
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+def parse_http_date(value: str) -> float:
+    '''Returns an HTTP-date as a timestamp, or None if it is missing or malformed.'''
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+class CacheEntry(object):
+    '''A stored response and the times needed to judge its freshness (RFC 7234 4.2).'''
+
+    def __init__(self, head: str, body: str, request_time: float, response_time: float):
+        self.head = head
+        self.body = body
+        self.request_time = request_time
+        self.response_time = response_time
+        self.response = Response.from_head(head, body)
+        self.cache_control = parse_cache_control(', '.join(self.response.get_all('Cache-Control')))
+
+    @property
+    def size(self) -> int:
+        return len(self.head) + len(self.body)
+
+    def lifetime(self) -> float:
+        '''Freshness lifetime from max-age, then Expires, then the Last-Modified heuristic.'''
+        try:
+            return float(self.cache_control['max-age'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        date = parse_http_date(self.response.get('Date')) or self.response_time
+        expires = self.response.get('Expires')
+        if expires is not None:
+            #Invalid Expires values (e.g "0") mean already expired
+            expires = parse_http_date(expires)
+            return expires - date if expires is not None else 0
+        last_modified = parse_http_date(self.response.get('Last-Modified'))
+        if last_modified is not None:
+            #A tenth of the time since the last change, as suggested by RFC 7234 4.2.2
+            return max(0, date - last_modified) / 10
+        return 0
+
+    def age(self, now: float) -> float:
+        '''Current age of the response (RFC 7234 4.2.3).'''
+        date = parse_http_date(self.response.get('Date')) or self.response_time
+        apparent_age = max(0, self.response_time - date)
+        try:
+            age_value = float(self.response.get('Age') or 0)
+        except ValueError:
+            age_value = 0
+        response_delay = self.response_time - self.request_time
+        corrected_initial_age = max(apparent_age, age_value + response_delay)
+        return corrected_initial_age + (now - self.response_time)
+
+    def fresh(self, now: float) -> bool:
+        if 'no-cache' in self.cache_control:
+            return False
+        return self.lifetime() > self.age(now)
+
+    def validators(self) -> list:
+        '''Conditional request headers that revalidate this entry.'''
+        headers = []
+        if self.response.get('ETag') is not None:
+            headers.append(StdHeader('If-None-Match', self.response.get('ETag')))
+        if self.response.get('Last-Modified') is not None:
+            headers.append(StdHeader('If-Modified-Since', self.response.get('Last-Modified')))
+        return headers
+
+    def updated(self, not_modified: Response, request_time: float, response_time: float):
+        '''Returns a copy of this entry with the headers of a 304 response merged in (RFC 7234 4.3.4).'''
+        #Framing headers describe the empty 304 body, not the stored one
+        merged = [header for header in not_modified.headers[1:]
+                  if header.field.lower() not in ('content-length', 'transfer-encoding')]
+        replaced = {header.field.lower() for header in merged}
+        headers = self.response.headers[:1]
+        headers += [header for header in self.response.headers[1:] if header.field.lower() not in replaced]
+        headers += merged
+        head = ''.join([str(header) for header in headers]) + '\r\n'
+        return CacheEntry(head, self.body, request_time, response_time)
+
+    def to_json(self) -> str:
+        return json.dumps({'head': self.head, 'body': self.body,
+                           'request_time': self.request_time, 'response_time': self.response_time})
+
+    @classmethod
+    def from_json(cls, data: str):
+        fields = json.loads(data)
+        return cls(fields['head'], fields['body'], fields['request_time'], fields['response_time'])
+
+class HTTPCache(object):
+    '''Private HTTP cache for GET responses (RFC 7234), placed in front of HTTPClient.communicate_r.
+
+    Fresh entries are served without touching the network, stale ones are revalidated with
+    If-None-Match/If-Modified-Since and a 304 answer turns into the stored response.
+    Entries are kept in memory, least recently used evicted first once max_bytes is exceeded.
+    With a directory, entries are also written there and survive the process.
+    '''
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, directory: str = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+
+    @staticmethod
+    def key(request: Request) -> tuple:
+        #GET args travel in the body, so they are part of what identifies the resource
+        return (request.get('Host'), request.get('Path'), request.body)
+
+    def fetch(self, request: Request, send, build):
+        '''Answers request from the cache where possible.
+        send(request) performs the network request, build(head, body) makes a response from an entry.'''
+        key = self.key(request)
+        request_time = time.time()
+        entry = self.lookup(key)
+        if entry is not None:
+            if entry.fresh(request_time):
+                self.hits += 1
+                return build(entry.head, entry.body)
+            for header in entry.validators():
+                request.add_header(header)
+
+        response = send(request)
+        response_time = time.time()
+        if entry is not None and response.code == 304:
+            self.revalidations += 1
+            entry = entry.updated(response, request_time, response_time)
+            self.store(key, entry)
+            return build(entry.head, entry.body)
+
+        self.misses += 1
+        if self.storable(response):
+            entry = CacheEntry(response.head(), response.body, request_time, response_time)
+            #Without freshness or validators an entry could never be used
+            if entry.lifetime() > 0 or entry.validators():
+                self.store(key, entry)
+        return response
+
+    @staticmethod
+    def storable(response: Response) -> bool:
+        directives = parse_cache_control(', '.join(response.get_all('Cache-Control')))
+        if 'no-store' in directives or response.get('Vary') == '*':
+            return False
+        return response.code in CACHEABLE_CODES and isinstance(response.body, str)
+
+    def lookup(self, key: tuple) -> CacheEntry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.directory is not None:
+            try:
+                with open(self._path(key), encoding = 'utf-8') as f:
+                    entry = CacheEntry.from_json(f.read())
+            except (OSError, ValueError, KeyError):
+                return None
+            self._remember(key, entry)
+        return entry
+
+    def store(self, key: tuple, entry: CacheEntry):
+        self._remember(key, entry)
+        if self.directory is not None:
+            #Written aside then renamed, so readers never see half an entry
+            path = self._path(key)
+            with open(path + '.tmp', 'w', encoding = 'utf-8') as f:
+                f.write(entry.to_json())
+            os.replace(path + '.tmp', path)
+
+    def invalidate(self, host: str, path: str):
+        '''Drops every entry for a resource, e.g after an unsafe request to it (RFC 7234 4.4).'''
+        with self._lock:
+            for key in [key for key in self._entries if key[:2] == (host, path)]:
+                self.size -= self._entries.pop(key).size
+        if self.directory is not None:
+            prefix = self._digest(host, path) + '-'
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(self.directory, name))
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations,
+                'entries': len(self._entries), 'bytes': self.size}
+
+    def _remember(self, key: tuple, entry: CacheEntry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self.size -= self._entries.popitem(last = False)[1].size
+
+    @staticmethod
+    def _digest(*parts) -> str:
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key: tuple) -> str:
+        #Named by resource then by body, so a resource's entries can be found by prefix
+        name = f'{self._digest(*key[:2])}-{self._digest(key[2])}.json'
+        return os.path.join(self.directory, name)
@@ -5,8 +5,8 @@ mapping = {
     'Content-Type': 'application/x-www-form-urlencoded',                         #Only used for POST
     'Accept': 'text/html, application/xhtml+xml, application/xml, text/html',
     'Accept-Language': 'en, en-CA, en-US',
-    'Connection': 'close',
+    'Connection': 'keep-alive',
     'User-Agent': "Jonathan's cURL Copycat/1.0",
-    'Accept-Encoding': 'identity',
+    'Accept-Encoding': 'gzip, deflate',                                          #Decoded by the client
     'Upgrade-Insecure-Requests': '0',                                           #No TLS allowed :>
 }
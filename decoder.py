@@ -0,0 +1,94 @@
+import zlib
+
+#Largest decoded body accepted by default, guarding against decompression bombs
+MAX_DECODED_SIZE = 256 * 1024 * 1024
+
+class ContentDecodingError(ValueError):
+    '''A compressed body could not be decoded.'''
+
+class DecompressionBombError(ContentDecodingError):
+    '''A compressed body expanded past the allowed size.'''
+
+class ContentDecoder(object):
+    '''Incrementally undoes a gzip or deflate Content-Encoding, one piece of body at a time.
+
+    max_size caps the total decoded output; exceeding it raises DecompressionBombError
+    without inflating the rest of the data. A max_length passed to decompress caps what one call
+    returns instead, keeping the input it didn't get to for the next call (see pending), so a
+    streaming reader holds no more than it asked for however well the body compresses.
+    '''
+
+    def __init__(self, encoding: str, max_size: int = MAX_DECODED_SIZE):
+        self.encoding = encoding
+        self.remaining = max_size
+        #gzip has its own header, deflate is meant to be zlib-wrapped but is sometimes sent raw
+        self._raw_fallback = encoding == 'deflate'
+        self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        #Whether the last call stopped at its max_length, so zlib may hold more output
+        self._full = False
+
+    @property
+    def pending(self) -> bool:
+        '''Whether decoded output is still owed for input already passed in, to be had with decompress(b'').'''
+        return bool(self._obj.unconsumed_tail) or self._full
+
+    def decompress(self, data, max_length: int = 0) -> bytes:
+        '''Decodes data after any input left over from the last call, returning at most max_length bytes
+        (0 for no limit other than max_size).'''
+        if self._obj.unconsumed_tail:
+            data = self._obj.unconsumed_tail + bytes(data)
+        #Asking for one byte more than allowed is enough to tell a bomb apart
+        limit = self.remaining + 1 if not max_length else min(max_length, self.remaining + 1)
+        try:
+            decoded = self._obj.decompress(data, limit)
+        except zlib.error as e:
+            if not self._raw_fallback:
+                raise ContentDecodingError(f'Invalid {self.encoding} body: {e}') from e
+            self._raw_fallback = False
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompress(data, max_length)
+        self._raw_fallback = False
+        self._full = len(decoded) >= limit
+        self.remaining -= len(decoded)
+        if self.remaining < 0:
+            raise DecompressionBombError(f'{self.encoding} body expands past the allowed size')
+        return decoded
+
+    def flush(self) -> bytes:
+        decoded = self._obj.flush()
+        self.remaining -= len(decoded)
+        if self.remaining < 0:
+            raise DecompressionBombError(f'{self.encoding} body expands past the allowed size')
+        return decoded
+
+class ChainDecoder(object):
+    '''Undoes several stacked encodings, the last one applied first. max_length only bounds the
+    final decoding, the stages before it pass on all they decode.'''
+
+    def __init__(self, decoders: list):
+        self.decoders = decoders
+
+    @property
+    def pending(self) -> bool:
+        return self.decoders[0].pending
+
+    def decompress(self, data, max_length: int = 0) -> bytes:
+        for decoder in reversed(self.decoders[1:]):
+            data = decoder.decompress(data)
+        return self.decoders[0].decompress(data, max_length)
+
+    def flush(self) -> bytes:
+        data = b''
+        for decoder in reversed(self.decoders):
+            data = decoder.decompress(data) + decoder.flush()
+        return data
+
+def get_decoder(content_encoding: str, max_size: int = MAX_DECODED_SIZE):
+    '''Returns a decoder for a Content-Encoding value, or None if there is nothing we can decode.
+    Bodies in encodings we don't support (e.g br) are left untouched.'''
+    encodings = [encoding.strip().lower() for encoding in (content_encoding or '').split(',')]
+    encodings = [encoding for encoding in encodings if encoding not in ('', 'identity')]
+    if not encodings or any(encoding not in ('gzip', 'x-gzip', 'deflate') for encoding in encodings):
+        return None
+    decoders = [ContentDecoder('deflate' if encoding == 'deflate' else 'gzip', max_size) for encoding in encodings]
+    return decoders[0] if len(decoders) == 1 else ChainDecoder(decoders)
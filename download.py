@@ -0,0 +1,93 @@
+import json
+import os
+import re
+import threading
+import time
+
+#Segments are at least this long, so small files aren't split over connections that cost more than they save
+MIN_SEGMENT_SIZE = 1024 * 1024
+#Most bytes read into the output file per read
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+#Seconds between writes of a running download's progress to its sidecar file
+CHECKPOINT_INTERVAL = 1.0
+PROGRESS_SUFFIX = '.progress'
+
+CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+
+class DownloadError(Exception):
+    '''The server didn't serve a download as asked, e.g an error status, or a range of a resource that changed.'''
+
+def split_ranges(length: int, segments: int) -> list:
+    '''Splits length bytes into up to segments [start, end) ranges of near-equal size, each at least
+    MIN_SEGMENT_SIZE (but the only one) long.'''
+    segments = max(1, min(segments, -(-length // MIN_SEGMENT_SIZE)))
+    bounds = [length * i // segments for i in range(segments + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(segments)]
+
+def validator(response) -> str:
+    '''The strong ETag of a response, or else its Last-Modified: what If-Range checks a range against.'''
+    etag = response.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return response.get('Last-Modified')
+
+class Progress(object):
+    '''Sidecar record of a segmented download, so an interrupted one can pick up where it stopped.
+
+    Each segment is a [start, next, end] list: bytes start up to next are in the output file, and
+    next up to end are still to be fetched. The thread fetching a segment moves its next along,
+    and checkpoint() writes the record out at most every CHECKPOINT_INTERVAL seconds.
+    '''
+
+    def __init__(self, path: str, url: str, length: int, validator: str, ranges: list):
+        self.path = path
+        self.url = url
+        self.length = length
+        self.validator = validator
+        self.segments = [[start, start, end] for start, end in ranges]
+        self.saved = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, url: str, length: int, validator: str):
+        '''The progress saved at path, or None if there is none or it is of another url or version of the resource.'''
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if (saved['url'], saved['length'], saved['validator']) != (url, length, validator):
+                return None
+            progress = cls(path, url, length, validator, [])
+            progress.segments = [[int(start), int(position), int(end)] for start, position, end in saved['segments']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return progress
+
+    def checkpoint(self, output):
+        '''Saves progress if CHECKPOINT_INTERVAL has passed, flushing output (the mapped file) first
+        so the record never claims bytes that aren't on disk.'''
+        if time.monotonic() - self.saved < CHECKPOINT_INTERVAL:
+            return
+        with self._lock:
+            if time.monotonic() - self.saved >= CHECKPOINT_INTERVAL:
+                #Taken before the flush, as other threads keep moving their segments along during it
+                segments = [list(segment) for segment in self.segments]
+                output.flush()
+                self.save(segments)
+
+    def save(self, segments: list = None):
+        '''Writes the record out, with segments in place of the current ones if given. It is replaced whole,
+        so a crash mid-write leaves the last one intact. Only one thread may save at a time: checkpoint()
+        holds the lock, the final save runs once fetching stops.'''
+        if segments is None:
+            segments = [list(segment) for segment in self.segments]
+        record = {'url': self.url, 'length': self.length, 'validator': self.validator, 'segments': segments}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.saved = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
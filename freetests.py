@@ -18,6 +18,8 @@
 
 import unittest
 import httpclient
+import asyncclient
+import asyncio
 import http.server
 import threading
 import socketserver
@@ -25,6 +27,15 @@ import random
 import time
 import urllib.parse
 import json
+import socket
+import os
+import tempfile
+import gzip
+import zlib
+import shutil
+import tracemalloc
+import loadgen
+import scheduler
 
 BASEHOST = '127.0.0.1'
 BASEPORT = 27600 + random.randint(1,100)
@@ -123,6 +134,165 @@ def post_header_check(self):
 
 
 
+# HTTP/1.1 variant that keeps connections open between requests
+class KeepAliveHTTPHandler(MyHTTPHandler):
+    protocol_version = "HTTP/1.1"
+    # client addresses of every request served, to count connections
+    peers = []
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def make_keepalive_server(host = BASEHOST, port = BASEPORT + 1):
+    return ThreadingHTTPServer( (host, port) , KeepAliveHTTPHandler)
+
+# repeats your path back with a Content-Length so the connection stays open
+def echo_path_keepalive(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    body = bytes("%s\n" % self.path,"utf-8")
+    self.send_response(200)
+    self.send_header("Content-type", "text/plain")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# repeats your path back using chunked transfer encoding
+def echo_path_chunked(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    self.send_response(200)
+    self.send_header("Content-type", "text/plain")
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    for part in (self.path, "\n"):
+        data = bytes(part,"utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+    self.wfile.write(b"0\r\n\r\n")
+
+# echoes the path, then drops the connection without warning on paths ending in /hangup
+def echo_then_hangup(self):
+    echo_path_keepalive(self)
+    if self.path.endswith("/hangup"):
+        self.close_connection = True
+
+# echoes the raw request body back, decoding chunked uploads, and says how it was framed
+def echo_body_keepalive(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    if self.headers.get("Transfer-Encoding") == "chunked":
+        framing = "chunked"
+        body = b""
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                break
+            body += self.rfile.read(size)
+            self.rfile.readline()
+    else:
+        framing = "length"
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+    self.send_response(200)
+    self.send_header("Content-type", "application/octet-stream")
+    self.send_header("X-Framing", framing)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# serves /fresh with a max-age and /etag as always-revalidate with an ETag
+def cacheable_keepalive(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    if self.path.startswith("/etag") and self.headers.get("If-None-Match") == '"v1"':
+        self.send_response(304)
+        self.send_header("ETag", '"v1"')
+        self.send_header("X-Revalidated", "yes")
+        self.end_headers()
+        return
+    body = bytes("%s %d\n" % (self.path, len(KeepAliveHTTPHandler.peers)),"utf-8")
+    self.send_response(200)
+    if self.path.startswith("/etag"):
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", '"v1"')
+    else:
+        self.send_header("Cache-Control", "max-age=60")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# sends the path compressed with the encoding named by the first path segment
+def compressed_keepalive(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    encoding = self.path.split("/")[1]
+    body = bytes(self.path * 1000,"utf-8")
+    if encoding == "gzip":
+        body = gzip.compress(body)
+    elif encoding == "deflate":
+        body = zlib.compress(body)
+    elif encoding == "bomb":
+        encoding = "gzip"
+        body = gzip.compress(bytes(64 * 1024 * 1024))
+    self.send_response(200)
+    self.send_header("Content-Encoding", encoding)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# sends a body of the size given in the path, containing blank lines
+def sized_body_keepalive(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    size = int(self.path.split("/")[-1])
+    body = (b"ab\r\n\r\ncd" * (size // 8 + 1))[:size]
+    self.send_response(200)
+    self.send_header("Content-type", "application/octet-stream")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# echoes the path after sleeping the seconds it names (/slow/0.5), only on the first request for paths ending in /once
+def slow_keepalive(self):
+    first = not KeepAliveHTTPHandler.peers
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    if first or not self.path.endswith("/once"):
+        time.sleep(float(self.path.split("/")[2]))
+    body = bytes("%s\n" % self.path,"utf-8")
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# /redirect/<code>/<path> redirects to /<path>, /absolute/<path> does so with an absolute url,
+# /loop redirects to itself, /secure off to https and /unix to a local socket; anything else echoes
+# the method, path and body
+def redirect_keepalive(self):
+    KeepAliveHTTPHandler.peers.append(self.client_address)
+    length = int(self.headers.get("Content-Length") or 0)
+    request_body = self.rfile.read(length) if length else b""
+    parts = self.path.split("/", 3)
+    if parts[1] == "redirect":
+        code, location = int(parts[2]), "/" + parts[3]
+    elif parts[1] == "absolute":
+        code, location = 302, "http://%s:%d/%s" % (BASEHOST, BASEPORT + 1, "/".join(parts[2:]))
+    elif self.path == "/loop":
+        code, location = 302, "loop"
+    elif self.path == "/secure":
+        code, location = 301, "https://%s/" % BASEHOST
+    elif self.path == "/unix":
+        code, location = 307, "http+unix://%2Fvar%2Frun%2Fdocker.sock/internal"
+    else:
+        code, location = 200, None
+    body = b"" if location else b"%s %s %s" % (self.command.encode(), self.path.encode(), request_body)
+    self.send_response(code)
+    if location:
+        self.send_header("Location", location)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+def fill_low_descriptors():
+    '''Opens descriptors until new ones land past select()'s limit of 1024, returns them for closing.'''
+    held = [os.open(os.devnull, os.O_RDONLY)]
+    while held[-1] < 1100:
+        held.append(os.dup(held[0]))
+    return held
+
 class TestHTTPClient(unittest.TestCase):
     httpd = None
     running = False
@@ -264,6 +434,1282 @@ class TestHTTPClient(unittest.TestCase):
             TestHTTPClient.httpd.server_close()
             time.sleep(1)
 
+class TestKeepAliveHTTPClient(unittest.TestCase):
+    '''Tests against an HTTP/1.1 server that supports persistent connections'''
+    httpd = None
+
+    @classmethod
+    def setUpClass(self):
+        socketserver.TCPServer.allow_reuse_address = True
+        TestKeepAliveHTTPClient.httpd = make_keepalive_server()
+        threading.Thread(target=TestKeepAliveHTTPClient.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(self):
+        TestKeepAliveHTTPClient.httpd.shutdown()
+        TestKeepAliveHTTPClient.httpd.server_close()
+
+    def setUp(self):
+        KeepAliveHTTPHandler.get = echo_path_keepalive
+        KeepAliveHTTPHandler.peers = []
+        self.base = "http://%s:%d" % (BASEHOST, BASEPORT + 1)
+
+    def testConnectionReuse(self):
+        '''Sequential requests to one origin share a connection'''
+        http = httpclass.HTTPClient()
+        for i in range(5):
+            req = http.GET("%s/reuse/%d" % (self.base, i))
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body == "/reuse/%d\n" % i, "Data: [%s] " % req.body)
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1, "Peers: %s" % KeepAliveHTTPHandler.peers)
+        http.close()
+
+    def testChunkedOnKeepAlive(self):
+        '''Chunked responses end without the server closing'''
+        KeepAliveHTTPHandler.get = echo_path_chunked
+        http = httpclass.HTTPClient()
+        for i in range(2):
+            req = http.GET("%s/chunked/%d" % (self.base, i))
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body == "/chunked/%d\n" % i, "Data: [%s] " % req.body)
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1)
+        http.close()
+
+    def testLargeBody(self):
+        '''Content-Length bodies are read exactly, even when they contain blank lines'''
+        KeepAliveHTTPHandler.get = sized_body_keepalive
+        http = httpclass.HTTPClient()
+        for size in (0, 7, 3 * 1024 * 1024 + 5):
+            req = http.GET("%s/sized/%d" % (self.base, size))
+            self.assertTrue(req.code == 200)
+            self.assertTrue(len(req.body) == size, "Got %d bytes" % len(req.body))
+            self.assertTrue(req.body[:8] == "ab\r\n\r\ncd"[:size])
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1)
+        http.close()
+
+    def testDeclaredLength(self):
+        '''A Content-Length is only trusted so far, the body buffer grows with the bytes that come'''
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while self.rfile.readline() not in (b"\r\n", b""):
+                    pass
+                self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: 100000000000\r\n\r\nhello")
+
+        http = httpclass.HTTPClient(transport = httpclass.LoopbackTransport(Handler))
+        tracemalloc.start()
+        try:
+            self.assertRaises(Exception, http.GET, "http://huge.test/")
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        http.close()
+        self.assertTrue(peak < 64 * 1024 * 1024, "Peak %d" % peak)
+        # bodies past the preallocation still read back whole
+        KeepAliveHTTPHandler.get = sized_body_keepalive
+        preallocate = httpclass.BODY_PREALLOCATE_SIZE
+        httpclass.BODY_PREALLOCATE_SIZE = 1000
+        try:
+            http = httpclass.HTTPClient()
+            req = http.GET("%s/sized/%d" % (self.base, 3 * 1024 * 1024 + 5))
+            self.assertTrue(len(req.body) == 3 * 1024 * 1024 + 5)
+            self.assertTrue(req.body[:8] == "ab\r\n\r\ncd")
+            http.close()
+        finally:
+            httpclass.BODY_PREALLOCATE_SIZE = preallocate
+
+    def testAsyncGET(self):
+        '''Concurrent GETs from AsyncHTTPClient share a bounded set of connections'''
+        http = asyncclient.AsyncHTTPClient(max_concurrency = 4)
+        paths = ["/async/%d" % i for i in range(20)]
+        async def fetch_all():
+            return await asyncio.gather(*(http.GET(self.base + path) for path in paths))
+        loop = asyncio.new_event_loop()
+        try:
+            reqs = loop.run_until_complete(fetch_all())
+            http.close()
+        finally:
+            loop.close()
+        for path, req in zip(paths, reqs):
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body == path + "\n", "Data: [%s] " % req.body)
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) <= 4)
+
+    def testFetchMany(self):
+        '''Batch fetches report every result, failures included, without exiting'''
+        http = httpclass.HTTPClient()
+        urls = ["%s/many/%d" % (self.base, i) for i in range(12)]
+        bad = "http://%s:%d/refused" % (BASEHOST, 1)
+        results = list(http.fetch_many(urls + [bad], max_workers = 4))
+        self.assertTrue(len(results) == 13)
+        for url, req in results:
+            if url == bad:
+                self.assertTrue(isinstance(req, ConnectionError), "Got %r" % req)
+            else:
+                self.assertTrue(req.code == 200)
+                self.assertTrue(url.endswith(req.body.strip()))
+        ordered = [url for url, req in http.fetch_many(urls, max_workers = 4, ordered = True)]
+        self.assertTrue(ordered == urls)
+        http.close()
+
+    def testPipeline(self):
+        '''Pipelined GETs come back in order over one connection'''
+        http = httpclass.HTTPClient(pipeline_depth = 4)
+        urls = ["%s/pipe/%d" % (self.base, i) for i in range(10)]
+        reqs = http.pipeline(urls)
+        self.assertTrue([req.body for req in reqs] == ["/pipe/%d\n" % i for i in range(10)])
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1)
+        http.close()
+
+    def testPipelineReplay(self):
+        '''Requests unanswered when the server hangs up mid-pipeline are replayed'''
+        KeepAliveHTTPHandler.get = echo_then_hangup
+        http = httpclass.HTTPClient(pipeline_depth = 4)
+        paths = ["/pipe/0", "/pipe/1/hangup", "/pipe/2", "/pipe/3", "/pipe/4/hangup", "/pipe/5"]
+        reqs = http.pipeline([self.base + path for path in paths])
+        self.assertTrue([req.body for req in reqs] == [path + "\n" for path in paths])
+        # Responses lost to a reset may be replayed on yet another connection
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) >= 3)
+        http.close()
+
+    def testStreamedBody(self):
+        '''Streamed bodies arrive in chunks and release the connection once consumed'''
+        KeepAliveHTTPHandler.get = sized_body_keepalive
+        http = httpclass.HTTPClient()
+        size = 1024 * 1024 + 3
+        req = http.GET("%s/sized/%d" % (self.base, size), stream = True)
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body.read(8) == b"ab\r\n\r\ncd")
+        chunks = list(req.body)
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(sum(map(len, chunks)) == size - 8)
+
+        path = tempfile.mktemp()
+        try:
+            req = http.GET("%s/sized/%d" % (self.base, size), stream = True)
+            self.assertTrue(req.body.save(path) == size)
+            self.assertTrue(os.path.getsize(path) == size)
+        finally:
+            os.remove(path)
+
+        KeepAliveHTTPHandler.get = echo_path_chunked
+        req = http.GET("%s/chunked" % self.base, stream = True)
+        self.assertTrue(req.body.read() == b"/chunked\n")
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1)
+        http.close()
+
+        # An empty body hands its connection straight back, where another request may pick it up at once
+        KeepAliveHTTPHandler.get = sized_body_keepalive
+        http = httpclass.HTTPClient(deadline = 30)
+        taken = []
+        release = http.pool.release
+        def release_and_take(conn, reusable = True):
+            release(conn, reusable)
+            taken.append(http.pool.acquire(conn.host, conn.port, scheme = conn.scheme))
+            taken[-1].set_deadline(time.monotonic() + 60)
+        http.pool.release = release_and_take
+        req = http.GET("%s/sized/0" % self.base, stream = True)
+        self.assertTrue(req.body.read() == b"")
+        self.assertTrue(taken[0].deadline is not None)
+        self.assertTrue(0 < req.timing.bytes_received < 1000)
+        taken[0].set_deadline(None)
+        release(taken[0])
+        http.close()
+
+    def testPOSTBodies(self):
+        '''Bytes, file and generator bodies are uploaded intact'''
+        KeepAliveHTTPHandler.post = echo_body_keepalive
+        http = httpclass.HTTPClient()
+        url = "%s/upload" % self.base
+        data = bytes(range(256)) * 1000
+
+        req = http.POST(url, body = data)
+        self.assertTrue(req.get("X-Framing") == "length")
+        self.assertTrue(req.body.encode("ISO-8859-1") == data)
+
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(1000)
+            req = http.POST(url, body = f)
+        self.assertTrue(req.get("X-Framing") == "length")
+        self.assertTrue(req.body.encode("ISO-8859-1") == data[1000:])
+
+        req = http.POST(url, body = (data[i:i + 4096] for i in range(0, len(data), 4096)))
+        self.assertTrue(req.get("X-Framing") == "chunked")
+        self.assertTrue(req.body.encode("ISO-8859-1") == data)
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1)
+        http.close()
+
+    def testPOSTFile(self):
+        '''Regular files are uploaded with sendfile, pipes fall back to chunked blocks'''
+        KeepAliveHTTPHandler.post = echo_body_keepalive
+        http = httpclass.HTTPClient()
+        url = "%s/upload" % self.base
+        data = bytes(range(256)) * 4000
+        sent = []
+        sendfile = httpclass.Connection.sendfile
+        def spy(conn, file, count):
+            sent.append(count)
+            return sendfile(conn, file, count)
+        httpclass.Connection.sendfile = spy
+        try:
+            with tempfile.NamedTemporaryFile(delete = False) as f:
+                f.write(data)
+            req = http.POST(url, file = f.name)
+            self.assertTrue(req.get("X-Framing") == "length")
+            self.assertTrue(req.body.encode("ISO-8859-1") == data)
+            self.assertTrue(sent == [len(data)])
+            self.assertTrue(req.timing.bytes_sent > len(data))
+
+            read, write = os.pipe()
+            writer = threading.Thread(target = lambda: (os.write(write, data[:5000]), os.close(write)))
+            writer.start()
+            with os.fdopen(read, "rb") as pipe:
+                req = http.POST(url, file = pipe)
+            writer.join()
+            self.assertTrue(req.get("X-Framing") == "chunked")
+            self.assertTrue(req.body.encode("ISO-8859-1") == data[:5000])
+            self.assertTrue(sent == [len(data)])
+        finally:
+            httpclass.Connection.sendfile = sendfile
+            os.unlink(f.name)
+            http.close()
+
+    def testVectoredSend(self):
+        '''Heads and bodies go out in one gather write, without being joined, over TCP_NODELAY sockets'''
+        KeepAliveHTTPHandler.post = echo_body_keepalive
+        http = httpclass.HTTPClient()
+        url = "%s/upload" % self.base
+        data = bytes(range(256)) * 1000
+        writes = []
+        sendmsg = httpclass.Connection.sendmsg
+        def spy(conn, buffers):
+            writes.append(list(buffers))
+            return sendmsg(conn, buffers)
+        httpclass.Connection.sendmsg = spy
+        try:
+            req = http.POST(url, body = data)
+            self.assertTrue(req.body.encode("ISO-8859-1") == data)
+            self.assertTrue(len(writes) == 1 and len(writes[0]) == 2)
+            self.assertTrue(writes[0][1] is data)
+            writes.clear()
+            req = http.POST(url, body = iter([data[:10], data[10:]]))
+            self.assertTrue(req.body.encode("ISO-8859-1") == data)
+            # The head rides along with the first chunk
+            self.assertTrue([len(buffers) for buffers in writes] == [4, 3, 1])
+        finally:
+            httpclass.Connection.sendmsg = sendmsg
+            http.close()
+
+        sock = httpclass.TCPTransport().connect(BASEHOST, BASEPORT + 1)
+        self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        sock.close()
+
+        # Short writes pick up where they stopped
+        class Trickle(object):
+            def __init__(self, sock):
+                self.sock = sock
+            def gettimeout(self):
+                return None
+            def sendmsg(self, buffers):
+                return self.sock.send(b"".join([bytes(buffer) for buffer in buffers])[:7])
+        client, server = socket.socketpair()
+        conn = httpclass.Connection(Trickle(client), "trickle", 0)
+        conn.sendmsg([b"head\r\n", memoryview(b"body"), bytearray(b""), b"0123456789" * 3])
+        client.close()
+        received = b""
+        while True:
+            data = server.recv(1024)
+            if not data:
+                break
+            received += data
+        server.close()
+        self.assertTrue(received == b"head\r\nbody" + b"0123456789" * 3)
+        self.assertTrue(conn.bytes_sent == len(received))
+
+    def testResolverFailover(self):
+        '''Names resolve through the injected resolver, cached, trying each address in turn'''
+        lookups = []
+        def stub_getaddrinfo(host, port, family = 0, type = 0, *rest):
+            lookups.append(host)
+            return [(socket.AF_INET, socket.SOCK_STREAM, 0, "", (BASEHOST, 1)),
+                    (socket.AF_INET, socket.SOCK_STREAM, 0, "", (BASEHOST, BASEPORT + 1))]
+        resolver = httpclass.Resolver(ttl = 60, getaddrinfo = stub_getaddrinfo)
+        http = httpclass.HTTPClient(resolver = resolver)
+        url = "http://stub.invalid:%d/resolved" % (BASEPORT + 1)
+        req = http.GET(url)
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body == "/resolved\n")
+        http.close()
+        http.GET(url)
+        self.assertTrue(lookups == ["stub.invalid"])
+        self.assertTrue(resolver.hits == 1 and resolver.misses == 1)
+        http.close()
+
+    def testIPv6(self):
+        '''Bracketed IPv6 literals connect over AF_INET6'''
+        class Server(ThreadingHTTPServer):
+            address_family = socket.AF_INET6
+        try:
+            server = Server(("::1", 0), KeepAliveHTTPHandler)
+        except OSError:
+            self.skipTest("IPv6 loopback unavailable")
+        KeepAliveHTTPHandler.get = echo_path_keepalive
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        try:
+            http = httpclass.HTTPClient()
+            self.assertTrue(http.get_host_port("[::1]:%d" % server.server_address[1]) == ("::1", server.server_address[1]))
+            self.assertTrue(http.get_host_port("[::1]") == ("::1", 80))
+            req = http.GET("http://[::1]:%d/six" % server.server_address[1])
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body == "/six\n")
+            http.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testResolverEviction(self):
+        '''The cache is bounded and entries expire'''
+        stub = lambda host, port, *rest: [(socket.AF_INET, socket.SOCK_STREAM, 0, "", (host, port))]
+        resolver = httpclass.Resolver(ttl = 60, max_entries = 2, getaddrinfo = stub)
+        for host in ("a", "b", "a", "c", "a", "b"):
+            resolver.resolve(host, 80)
+        # b was least recently used when c arrived
+        self.assertTrue(resolver.hits == 2 and resolver.misses == 4, resolver.stats)
+        expired = httpclass.Resolver(ttl = 0, getaddrinfo = stub)
+        expired.resolve("a", 80)
+        expired.resolve("a", 80)
+        self.assertTrue(expired.misses == 2)
+
+    def testCache(self):
+        '''Fresh responses skip the network and stale ones are revalidated'''
+        KeepAliveHTTPHandler.get = cacheable_keepalive
+        KeepAliveHTTPHandler.post = echo_body_keepalive
+        directory = tempfile.mkdtemp()
+        cache = httpclass.HTTPCache(directory = directory)
+        http = httpclass.HTTPClient(cache = cache)
+
+        first = http.GET("%s/fresh" % self.base)
+        second = http.GET("%s/fresh" % self.base)
+        self.assertTrue(first.body == second.body == "/fresh 1\n")
+        self.assertTrue(len(KeepAliveHTTPHandler.peers) == 1)
+
+        first = http.GET("%s/etag" % self.base)
+        second = http.GET("%s/etag" % self.base)
+        self.assertTrue(second.code == 200 and second.body == first.body == "/etag 2\n")
+        self.assertTrue(second.get("X-Revalidated") == "yes")
+        self.assertTrue(len(KeepAliveHTTPHandler.peers) == 3)
+        self.assertTrue(cache.stats["hits"] == 1 and cache.stats["misses"] == 2
+                        and cache.stats["revalidations"] == 1, cache.stats)
+
+        # A fresh cache over the same directory picks the entries up from disk
+        http = httpclass.HTTPClient(cache = httpclass.HTTPCache(directory = directory))
+        self.assertTrue(http.GET("%s/fresh" % self.base).body == "/fresh 1\n")
+        self.assertTrue(len(KeepAliveHTTPHandler.peers) == 3)
+
+        # Unsafe requests invalidate what was cached for the resource
+        http.POST("%s/fresh" % self.base, body = b"x")
+        self.assertTrue(http.GET("%s/fresh" % self.base).body == "/fresh 5\n")
+        http.close()
+        shutil.rmtree(directory)
+
+    def testContentDecoding(self):
+        '''gzip and deflate bodies are decoded, buffered or streamed, within a size limit'''
+        KeepAliveHTTPHandler.get = compressed_keepalive
+        http = httpclass.HTTPClient(max_decoded_size = 1024 * 1024)
+        for encoding in ("gzip", "deflate"):
+            path = "/%s/body" % encoding
+            req = http.GET(self.base + path)
+            self.assertTrue(req.body == path * 1000, encoding)
+            req = http.GET(self.base + path, stream = True)
+            self.assertTrue(b"".join(req.body.iter_chunks(100)) == bytes(path * 1000,"utf-8"))
+
+        self.assertRaises(httpclass.DecompressionBombError, http.GET, self.base + "/bomb")
+        http.close()
+
+        # Streamed, a highly compressed body is only inflated as far as each read asks
+        http = httpclass.HTTPClient()
+        req = http.GET(self.base + "/bomb", stream = True)
+        tracemalloc.start()
+        try:
+            total = sum(len(chunk) for chunk in req.body.iter_chunks())
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(total == 64 * 1024 * 1024)
+        self.assertTrue(peak < 2 * 1024 * 1024, peak)
+        http.close()
+
+        raw = httpclass.HTTPClient(decode_content = False)
+        req = raw.GET(self.base + "/gzip/body")
+        self.assertTrue(gzip.decompress(req.body.encode("ISO-8859-1")) == bytes("/gzip/body" * 1000,"utf-8"))
+        raw.close()
+
+    def testStaleConnectionRetry(self):
+        '''A pooled connection closed behind our back is replaced transparently'''
+        http = httpclass.HTTPClient()
+        http.GET("%s/first" % self.base)
+        for conns in http.pool._idle.values():
+            for conn in conns:
+                # Simulate the server dropping the idle socket
+                conn.socket.shutdown(socket.SHUT_RDWR)
+        req = http.GET("%s/second" % self.base)
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body == "/second\n")
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 2)
+        http.close()
+
+    def testPoolWaitersPerOrigin(self):
+        '''A freed slot wakes a waiter for its own origin, even behind waiters for another'''
+        pool = httpclass.ConnectionPool(lambda host, port, timing, deadline, scheme: socket.socketpair()[0],
+                                        max_per_host = 1)
+        held = {host: pool.acquire(host, 80) for host in ("x", "y")}
+        got = {}
+        def take(host):
+            got[host] = pool.acquire(host, 80)
+        waiters = {host: threading.Thread(target = take, args = (host,), daemon = True) for host in ("x", "y")}
+        for host in ("x", "y"):
+            waiters[host].start()
+            time.sleep(0.1)
+        pool.release(held["y"])
+        waiters["y"].join(5)
+        self.assertTrue("y" in got and "x" not in got, "Got %s" % got)
+        pool.discard(held["x"])
+        waiters["x"].join(5)
+        self.assertTrue("x" in got)
+        for conn in got.values():
+            pool.release(conn)
+        pool.close()
+
+    def testHighDescriptors(self):
+        '''Idle connections on descriptors past 1024 are still pooled'''
+        held = fill_low_descriptors()
+        try:
+            http = httpclass.HTTPClient()
+            for i in range(3):
+                req = http.GET("%s/high/%d" % (self.base, i))
+                self.assertTrue(req.body == "/high/%d\n" % i)
+            self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1, "Peers: %s" % KeepAliveHTTPHandler.peers)
+            http.close()
+        finally:
+            for fd in held:
+                os.close(fd)
+
+    def testTimingAndHooks(self):
+        '''Responses carry a timing breakdown and hooks see each request'''
+        events = []
+        http = httpclass.HTTPClient(hooks = {
+            'on_request': lambda request: events.append(('request', request.get('Path'))),
+            'on_connect': lambda host, port, timing: events.append(('connect', port)),
+            'on_response': lambda request, response: events.append(('response', response.code)),
+        })
+        http.add_hook('on_error', lambda request, e: events.append(('error', type(e))))
+        first = http.GET("%s/first" % self.base)
+        second = http.GET("%s/second" % self.base)
+        self.assertTrue(events == [('request', '/first'), ('connect', BASEPORT + 1), ('response', 200),
+                                   ('request', '/second'), ('response', 200)], events)
+
+        timing = first.timing
+        self.assertFalse(timing.reused)
+        stamps = [timing.start, timing.resolve_start, timing.resolve_end, timing.connect_end,
+                  timing.request_sent, timing.first_byte, timing.last_byte]
+        self.assertTrue(stamps == sorted(stamps), stamps)
+        self.assertTrue(timing.bytes_sent == len(http.serializer.build("GET", "%s/first" % self.base, None).head_bytes()))
+        self.assertTrue(timing.bytes_received > len("/first\n"))
+        self.assertTrue(second.timing.reused)
+        self.assertTrue(second.timing.durations()['connect'] is None)
+        self.assertTrue(second.timing.durations()['total'] > 0)
+
+        streamed = http.GET("%s/streamed" % self.base, stream = True)
+        self.assertTrue(streamed.timing.last_byte is None)
+        self.assertTrue(streamed.body.read() == b"/streamed\n")
+        self.assertTrue(streamed.timing.last_byte >= streamed.timing.first_byte)
+        self.assertTrue(streamed.timing.bytes_received > len("/streamed\n"))
+
+        self.assertRaises(ValueError, http.add_hook, 'on_nothing', print)
+        http.close()
+        self.assertRaises(ConnectionError, http.GET, "http://localhost:%d/" % (BASEPORT + 9))
+        self.assertTrue(events[-1] == ('error', ConnectionError), events)
+
+    def testTimeouts(self):
+        '''Slow peers raise typed timeouts instead of blocking forever'''
+        KeepAliveHTTPHandler.get = slow_keepalive
+        http = httpclass.HTTPClient(read_timeout = 0.2)
+        self.assertRaises(httpclass.ReadTimeout, http.GET, "%s/slow/1" % self.base)
+        # the timed out connection isn't pooled, and quick requests still go through
+        self.assertTrue(http.GET("%s/slow/0" % self.base).code == 200)
+
+        http = httpclass.HTTPClient(read_timeout = 0.5, deadline = 0.3)
+        start = time.monotonic()
+        self.assertRaises(httpclass.DeadlineExceeded, http.GET, "%s/slow/1" % self.base)
+        self.assertTrue(time.monotonic() - start < 0.5)
+        self.assertTrue(issubclass(httpclass.DeadlineExceeded, TimeoutError))
+
+        # a full accept queue leaves further connects hanging
+        listener = socket.socket()
+        listener.bind((BASEHOST, 0))
+        listener.listen(0)
+        backlog = []
+        for i in range(3):
+            sock = socket.socket()
+            sock.setblocking(False)
+            try:
+                sock.connect(listener.getsockname())
+            except BlockingIOError:
+                pass
+            backlog.append(sock)
+        try:
+            http = httpclass.HTTPClient(connect_timeout = 0.2)
+            url = "http://%s:%d/" % listener.getsockname()
+            self.assertRaises(httpclass.ConnectTimeout, http.GET, url)
+            # still a ConnectionError to callers that only know about those
+            self.assertRaises(ConnectionError, http.GET, url)
+        finally:
+            for sock in backlog + [listener]:
+                sock.close()
+
+    def testHedgedGET(self):
+        '''A GET stuck on a slow connection is answered by its duplicate'''
+        KeepAliveHTTPHandler.get = slow_keepalive
+        policy = httpclass.HedgePolicy(initial_delay = 0.05)
+        errors = []
+        http = httpclass.HTTPClient(hedge = policy, hooks = {'on_error': lambda request, e: errors.append(e)})
+        start = time.monotonic()
+        req = http.GET("%s/slow/1/once" % self.base)
+        self.assertTrue(time.monotonic() - start < 0.8)
+        self.assertTrue(req.body == "/slow/1/once\n")
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 2)
+        self.assertTrue(policy.stats['hedged'] == 1 and policy.stats['hedge_wins'] == 1, policy.stats)
+        # fast answers never send a duplicate
+        for i in range(5):
+            self.assertTrue(http.GET("%s/slow/0/once" % self.base).code == 200)
+        self.assertTrue(policy.stats['requests'] == 6 and policy.stats['hedged'] == 1, policy.stats)
+        # the cancelled copy isn't reported as a failure
+        self.assertTrue(errors == [], errors)
+        executor = http._hedge_executor
+        http.close()
+        # closing stops the hedging threads
+        self.assertTrue(http._hedge_executor is None and executor._shutdown)
+
+    def testAttemptDetach(self):
+        '''Cancelling a hedged copy leaves alone a connection it has handed back'''
+        ours, theirs = socket.socketpair()
+        conn = httpclass.Connection(ours, "x", 80)
+        attempt = httpclass.Attempt()
+        self.assertTrue(attempt.attach(conn))
+        attempt.detach()
+        attempt.cancel()
+        conn.sendall(b"still open")
+        self.assertTrue(theirs.recv(16) == b"still open")
+        # a cancelled copy doesn't start on a new connection
+        self.assertFalse(attempt.attach(conn))
+        ours.close()
+        theirs.close()
+
+    def testRedirects(self):
+        '''3xx responses are followed on the same connection, rewriting the method where required'''
+        KeepAliveHTTPHandler.get = redirect_keepalive
+        KeepAliveHTTPHandler.post = redirect_keepalive
+        http = httpclass.HTTPClient()
+        req = http.GET("%s/redirect/302/absolute/final" % self.base)
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body == "GET /final ", req.body)
+        self.assertTrue([res.code for res in req.history] == [302, 302])
+        self.assertTrue(len(KeepAliveHTTPHandler.peers) == 3)
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) == 1)
+
+        args = {'a': 'b'}
+        self.assertTrue(http.POST("%s/redirect/303/final" % self.base, args).body == "GET /final ")
+        self.assertTrue(http.POST("%s/redirect/302/final" % self.base, args).body == "GET /final ")
+        self.assertTrue(http.POST("%s/redirect/307/final" % self.base, args).body == "POST /final a=b")
+        self.assertTrue(http.POST("%s/redirect/308/final" % self.base, body = b"raw").body == "POST /final raw")
+        # a file body is used up by the first hop
+        with tempfile.TemporaryFile() as f:
+            f.write(b"raw")
+            f.seek(0)
+            req = http.POST("%s/redirect/307/final" % self.base, body = f)
+            self.assertTrue(req.code == 307 and req.get("Location") == "/final")
+
+        req = http.GET("%s/redirect/302/final" % self.base, stream = True)
+        self.assertTrue(req.body.read() == b"GET /final ")
+
+        self.assertRaises(httpclass.TooManyRedirects, http.GET, "%s/loop" % self.base)
+        self.assertTrue(http.GET("%s/secure" % self.base).code == 301)
+        # A TCP origin can't send the client (or a POST body) to a local socket
+        self.assertTrue(http.GET("%s/unix" % self.base).code == 307)
+        self.assertTrue(http.POST("%s/unix" % self.base, body = b"secret").code == 307)
+        unix = "http+unix://%2Frun%2Fa.sock/x"
+        self.assertTrue(httpclass.redirect_target(unix, 302, "/y") == "http+unix://%2Frun%2Fa.sock/y")
+        self.assertTrue(httpclass.redirect_target(unix, 302, "http+unix://%2Frun%2Fa.sock/z") ==
+                        "http+unix://%2Frun%2Fa.sock/z")
+        self.assertTrue(httpclass.redirect_target(unix, 302, "http+unix://%2Frun%2Fb.sock/z") is None)
+        self.assertTrue(httpclass.redirect_target("http://%s/" % BASEHOST, 302, unix) is None)
+        self.assertTrue(httpclass.HTTPClient(max_redirects = 0).GET("%s/redirect/302/final" % self.base).code == 302)
+        http.close()
+
+    def testPermanentRedirectCache(self):
+        '''Known 301/308 redirects are taken without asking the server'''
+        KeepAliveHTTPHandler.get = redirect_keepalive
+        KeepAliveHTTPHandler.post = redirect_keepalive
+        redirects = httpclass.RedirectCache(max_entries = 2)
+        http = httpclass.HTTPClient(redirects = redirects)
+        for i in range(3):
+            self.assertTrue(http.GET("%s/redirect/301/final" % self.base).body == "GET /final ")
+        self.assertTrue(len(KeepAliveHTTPHandler.peers) == 4, KeepAliveHTTPHandler.peers)
+        self.assertTrue(redirects.stats == {'hits': 2, 'entries': 1}, redirects.stats)
+        # a cached 301 still turns a POST into a GET, a 308 keeps it
+        self.assertTrue(http.POST("%s/redirect/301/final" % self.base, {'a': 'b'}).body == "GET /final ")
+        http.POST("%s/redirect/308/final" % self.base, {'a': 'b'})
+        self.assertTrue(http.POST("%s/redirect/308/final" % self.base, {'a': 'b'}).body == "POST /final a=b")
+        # 302s aren't remembered, and the oldest entries make room for new ones
+        http.GET("%s/redirect/302/final" % self.base)
+        http.GET("%s/redirect/301/other" % self.base)
+        self.assertTrue(redirects.stats['entries'] == 2)
+        self.assertTrue(redirects.lookup("%s/redirect/301/final" % self.base) == None)
+        http.close()
+
+class TestLoadGenerator(unittest.TestCase):
+    '''Runs the load-test mode against the keep-alive server'''
+    httpd = None
+
+    @classmethod
+    def setUpClass(self):
+        socketserver.TCPServer.allow_reuse_address = True
+        TestLoadGenerator.httpd = make_keepalive_server()
+        threading.Thread(target=TestLoadGenerator.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(self):
+        TestLoadGenerator.httpd.shutdown()
+        TestLoadGenerator.httpd.server_close()
+
+    def setUp(self):
+        KeepAliveHTTPHandler.get = echo_path_keepalive
+        KeepAliveHTTPHandler.peers = []
+        self.url = "http://%s:%d/load" % (BASEHOST, BASEPORT + 1)
+
+    def testRequestCount(self):
+        result = loadgen.run("GET", self.url, requests = 25, concurrency = 4)
+        self.assertTrue(len(result['latencies']) == 25)
+        self.assertTrue(result['latencies'] == sorted(result['latencies']))
+        self.assertTrue(result['codes'] == {200: 25}, result['codes'])
+        self.assertTrue(result['errors'] == {})
+        # one connection per concurrent slot, reused for the rest
+        self.assertTrue(len(set(KeepAliveHTTPHandler.peers)) <= 4)
+        text = loadgen.summary(result)
+        self.assertTrue("Completed requests:   25" in text, text)
+        self.assertTrue("Latency distribution" in text, text)
+
+    def testProcessesAndDuration(self):
+        result = loadgen.run("GET", self.url, requests = 10, concurrency = 2, processes = 2)
+        self.assertTrue(result['codes'] == {200: 10}, result['codes'])
+        start = time.monotonic()
+        result = loadgen.run("GET", self.url, concurrency = 2, duration = 0.3)
+        self.assertTrue(0.3 <= time.monotonic() - start < 5)
+        self.assertTrue(len(result['latencies']) > 0)
+
+    def testErrorsByKind(self):
+        result = loadgen.run("GET", "http://%s:%d/" % (BASEHOST, BASEPORT + 9), requests = 3)
+        self.assertTrue(result['errors'] == {'ConnectionError': 3}, result['errors'])
+        self.assertTrue("ConnectionError" in loadgen.summary(result))
+        self.assertRaises(ValueError, loadgen.run, "GET", self.url)
+
+    def testHistogram(self):
+        buckets = loadgen.histogram([0.0004, 0.0009, 0.003, 0.03])
+        self.assertTrue(buckets == [('<= 0.5 ms', 1), ('<= 1 ms', 1), ('<= 2 ms', 0), ('<= 5 ms', 1),
+                                    ('<= 10 ms', 0), ('<= 20 ms', 0), ('<= 50 ms', 1)], buckets)
+        self.assertTrue(loadgen.histogram([]) == [])
+
+class TestTransports(unittest.TestCase):
+    '''Requests over Unix domain sockets and the in-memory loopback, no TCP server needed'''
+
+    class Handler(KeepAliveHTTPHandler):
+        get = echo_path_keepalive
+        post = echo_body_keepalive
+
+        def log_message(self, format, *args):
+            # Unix domain socket peers have no address to log
+            pass
+
+    def testLoopback(self):
+        transport = httpclass.LoopbackTransport(self.Handler)
+        http = httpclass.HTTPClient(transport = transport)
+        for path in ("/a", "/b"):
+            req = http.GET("http://example.test%s" % path)
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body == path + "\n")
+        req = http.POST("http://example.test/upload", body = b"x" * 100000)
+        self.assertTrue(req.body == "x" * 100000)
+        self.assertTrue(transport.connections == 1)
+        http.close()
+
+    def testSchemes(self):
+        '''The url's scheme picks the transport, and connections aren't shared across schemes'''
+        plain = httpclass.LoopbackTransport(self.Handler)
+        other = httpclass.LoopbackTransport(self.Handler)
+        http = httpclass.HTTPClient(transport = plain)
+        http.transports["http+test"] = other
+        for i in range(2):
+            self.assertTrue(http.GET("http://example.test/plain").body == "/plain\n")
+            self.assertTrue(http.GET("http+test://example.test/other").body == "/other\n")
+        self.assertTrue(plain.connections == 1 and other.connections == 1)
+        with self.assertRaises(ValueError) as raised:
+            http.GET("https://example.test/")
+        self.assertTrue("https" in str(raised.exception))
+        http.close()
+        # a transport that can't connect fails as it is made, not on first use
+        class Incomplete(httpclass.Transport):
+            pass
+        self.assertRaises(TypeError, Incomplete)
+
+    def testUnixSocket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "http.sock")
+        server = socketserver.ThreadingUnixStreamServer(path, self.Handler)
+        server.daemon_threads = True
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        try:
+            url = "http+unix://%s" % urllib.parse.quote(path, safe = "")
+            connects = []
+            http = httpclass.HTTPClient(hooks = {"on_connect": lambda host, port, timing: connects.append(host)})
+            for i in range(2):
+                req = http.GET(url + "/unix/%d" % i)
+                self.assertTrue(req.code == 200)
+                self.assertTrue(req.body == "/unix/%d\n" % i)
+            self.assertTrue(connects == [path])
+            self.assertTrue(req.timing.reused)
+            http.close()
+
+            async_client = asyncclient.AsyncHTTPClient()
+            loop = asyncio.new_event_loop()
+            try:
+                req = loop.run_until_complete(async_client.GET(url + "/async"))
+                async_client.close()
+            finally:
+                loop.close()
+            self.assertTrue(req.body == "/async\n")
+
+            self.assertRaises(ConnectionError, httpclass.HTTPClient().GET,
+                              "http+unix://%s/" % urllib.parse.quote(path + ".missing", safe = ""))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+
+class TestScheduler(unittest.TestCase):
+    '''Per host queueing, caps and rate limits in front of HTTPClient.command, over the loopback'''
+
+    class Handler(KeepAliveHTTPHandler):
+        lock = threading.Lock()
+        # host -> requests being served now, and the most at once
+        active = {}
+        peak = {}
+        # (host, path) in the order requests arrived
+        arrivals = []
+
+        def get(self):
+            host = self.client_address[0]
+            with self.lock:
+                self.arrivals.append((host, self.path))
+                self.active[host] = self.active.get(host, 0) + 1
+                self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+            if self.path.startswith("/slow/"):
+                time.sleep(float(self.path.split("/")[2]))
+            with self.lock:
+                self.active[host] -= 1
+            echo_path_keepalive(self)
+
+        def log_message(self, format, *args):
+            pass
+
+    def setUp(self):
+        self.Handler.active = {}
+        self.Handler.peak = {}
+        self.Handler.arrivals = []
+        self.client = httpclass.HTTPClient(transport = httpclass.LoopbackTransport(self.Handler))
+
+    def tearDown(self):
+        self.client.close()
+
+    def testCaps(self):
+        with scheduler.Scheduler(self.client, max_in_flight = 4, max_per_host = 2) as s:
+            slow = [s.submit("GET", "http://slow.test/slow/0.2", None) for i in range(4)]
+            time.sleep(0.05)
+            # The slow host is at its cap, other hosts get the free slots right away
+            start = time.monotonic()
+            fast = s.submit("GET", "http://fast.test/fast", None).result(5)
+            self.assertTrue(time.monotonic() - start < 0.15)
+            self.assertTrue(fast.body == "/fast\n")
+            stats = s.stats["slow.test"]
+            self.assertTrue(stats["in_flight"] == 2)
+            self.assertTrue(stats["queued"] == 2)
+            for future in slow:
+                self.assertTrue(future.result(5).body == "/slow/0.2\n")
+            stats = s.stats["slow.test"]
+            self.assertTrue(stats["sent"] == 4 and stats["queued"] == 0 and stats["in_flight"] == 0)
+            # The last two waited for the first two to finish
+            self.assertTrue(stats["wait_max"] >= 0.15)
+        self.assertTrue(self.Handler.peak["slow.test"] == 2)
+
+    def testRoundRobin(self):
+        s = scheduler.Scheduler(self.client, max_in_flight = 1)
+        # Held up so everything below queues behind it
+        first = s.submit("GET", "http://a.test/slow/0.1", None)
+        time.sleep(0.05)
+        futures = [s.submit("GET", "http://a.test/%d" % i, None) for i in range(3)]
+        futures += [s.submit("GET", "http://b.test/%d" % i, None) for i in range(3)]
+        self.assertTrue(s.stats["a.test"]["queued"] == 3)
+        s.close()
+        for future in [first] + futures:
+            self.assertTrue(future.result(5).code == 200)
+        self.assertTrue(self.Handler.arrivals[1:] == [("a.test", "/0"), ("b.test", "/0"), ("a.test", "/1"),
+                                                      ("b.test", "/1"), ("a.test", "/2"), ("b.test", "/2")])
+
+    def testRateLimit(self):
+        with scheduler.Scheduler(self.client, rates = {"limited.test": 20}, burst = 2) as s:
+            start = time.monotonic()
+            limited = [s.submit("GET", "http://limited.test/%d" % i, None) for i in range(6)]
+            free = [s.submit("GET", "http://free.test/%d" % i, None) for i in range(6)]
+            for future in free:
+                future.result(5)
+            free_time = time.monotonic() - start
+            for future in limited:
+                future.result(5)
+            # A burst of 2 then 4 more at 20 a second
+            self.assertTrue(time.monotonic() - start >= 0.18)
+            self.assertTrue(free_time < 0.15)
+        self.assertTrue(s.stats["limited.test"]["wait_max"] >= 0.15)
+
+    def testErrorsAndCancel(self):
+        s = scheduler.Scheduler(self.client, max_in_flight = 1)
+        first = s.submit("GET", "http://a.test/slow/0.1", None)
+        cancelled = s.submit("GET", "http://a.test/cancelled", None)
+        self.assertTrue(cancelled.cancel())
+        bad = s.submit("GET", "http://a.test:port/", None)
+        s.close()
+        self.assertTrue(first.result(5).code == 200)
+        self.assertRaises(ValueError, bad.result, 5)
+        self.assertTrue(("a.test", "/cancelled") not in self.Handler.arrivals)
+        self.assertRaises(RuntimeError, s.submit, "GET", "http://a.test/", None)
+
+class TestDownload(unittest.TestCase):
+    '''Segmented, resumable downloads with Range requests, over the loopback'''
+
+    blob = os.urandom(4 * 1024 * 1024 + 123)
+
+    class Handler(KeepAliveHTTPHandler):
+        lock = threading.Lock()
+        ranges = True
+        # Set to stop range responses after this many bytes of the first one requested
+        cut = None
+        # Range headers received, and body bytes sent
+        requested = []
+        sent = 0
+
+        def do_HEAD(self):
+            self.send_head(200, len(TestDownload.blob))
+
+        def send_head(self, code, length, content_range = None):
+            self.send_response(code)
+            self.send_header("Content-Length", str(length))
+            self.send_header("ETag", '"v1"')
+            if self.ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            if content_range is not None:
+                self.send_header("Content-Range", content_range)
+            self.end_headers()
+
+        def get(self):
+            blob = TestDownload.blob
+            header = self.headers.get("Range")
+            if header is None or not self.ranges:
+                start, end = 0, len(blob) - 1
+                self.send_head(200, len(blob))
+            else:
+                start, end = [int(value) for value in header[len("bytes="):].split("-")]
+                self.send_head(206, end - start + 1, "bytes %d-%d/%d" % (start, end, len(blob)))
+            with self.lock:
+                self.requested.append(header)
+                cut = type(self).cut
+                type(self).cut = None
+            data = blob[start:end + 1]
+            if cut is not None:
+                data = data[:cut]
+                self.close_connection = True
+            self.wfile.write(data)
+            with self.lock:
+                type(self).sent += len(data)
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.get()
+
+    def setUp(self):
+        self.Handler.ranges = True
+        self.Handler.cut = None
+        self.Handler.requested = []
+        self.Handler.sent = 0
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "blob")
+        self.transport = httpclass.LoopbackTransport(self.Handler)
+        self.client = httpclass.HTTPClient(transport = self.transport)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def testSegmented(self):
+        length = self.client.download("http://files.test/blob", self.path, segments = 4)
+        self.assertTrue(length == len(self.blob))
+        self.assertTrue(self.read() == self.blob)
+        self.assertTrue(len(self.Handler.requested) == 4)
+        self.assertTrue(self.transport.connections == 4)
+        self.assertTrue(self.Handler.sent == len(self.blob))
+        self.assertFalse(os.path.exists(self.path + ".progress"))
+
+    def testResume(self):
+        self.Handler.cut = 100000
+        self.assertRaises(ConnectionError, self.client.download, "http://files.test/blob", self.path, 4)
+        self.assertTrue(os.path.exists(self.path + ".progress"))
+        # The first range asked for was the one cut short
+        start, end = [int(value) for value in self.Handler.requested[0][len("bytes="):].split("-")]
+        self.assertTrue(self.Handler.sent == len(self.blob) - (end - start + 1) + 100000)
+        self.Handler.requested = []
+        self.assertTrue(self.client.download("http://files.test/blob", self.path, 4) == len(self.blob))
+        self.assertTrue(self.read() == self.blob)
+        # Only the missing part of the cut segment went again
+        self.assertTrue(self.Handler.requested == ["bytes=%d-%d" % (start + 100000, end)])
+        self.assertTrue(self.Handler.sent == len(self.blob))
+        self.assertFalse(os.path.exists(self.path + ".progress"))
+
+        # A changed resource starts over
+        self.Handler.cut = 100000
+        self.assertRaises(ConnectionError, self.client.download, "http://files.test/blob", self.path, 4)
+        with open(self.path + ".progress") as f:
+            progress = json.load(f)
+        progress["validator"] = '"v0"'
+        with open(self.path + ".progress", "w") as f:
+            json.dump(progress, f)
+        self.Handler.requested = []
+        self.assertTrue(self.client.download("http://files.test/blob", self.path, 4) == len(self.blob))
+        self.assertTrue(len(self.Handler.requested) == 4)
+        self.assertTrue(self.read() == self.blob)
+
+    def testNoRanges(self):
+        self.Handler.ranges = False
+        self.assertTrue(self.client.download("http://files.test/blob", self.path, 4) == len(self.blob))
+        self.assertTrue(self.read() == self.blob)
+        self.assertTrue(self.Handler.requested == [None])
+
+    def testCheckpoint(self):
+        '''A checkpoint records only what was flushed, not what arrived during the flush'''
+        progress = httpclass.Progress(self.path + ".progress", "http://files.test/blob", 100, None, [(0, 100)])
+
+        class Output(object):
+            def flush(self):
+                # another thread moves its segment along meanwhile
+                progress.segments[0][1] = 60
+
+        progress.segments[0][1] = 40
+        progress.saved -= 10
+        progress.checkpoint(Output())
+        self.assertTrue(progress.segments == [[0, 60, 100]])
+        saved = httpclass.Progress.load(self.path + ".progress", "http://files.test/blob", 100, None)
+        self.assertTrue(saved.segments == [[0, 40, 100]], saved.segments)
+
+    def testSmall(self):
+        blob = TestDownload.blob
+        TestDownload.blob = b"small"
+        try:
+            self.assertTrue(self.client.download("http://files.test/small", self.path, 4) == 5)
+            self.assertTrue(self.read() == b"small")
+            self.assertTrue(self.Handler.requested == ["bytes=0-4"])
+        finally:
+            TestDownload.blob = blob
+
+class TestExpectContinue(unittest.TestCase):
+    '''Large POST bodies wait for 100 (Continue) and aren't sent when the server answers first'''
+
+    class Handler(KeepAliveHTTPHandler):
+        post = echo_body_keepalive
+        # "continue" (http.server's default), "reject" with a 413, or "ignore" the Expect header
+        mode = "continue"
+        # Expect headers received
+        expects = []
+
+        def handle_expect_100(self):
+            self.expects.append(self.headers.get("Expect"))
+            if self.mode == "reject":
+                self.send_error(413)
+                return False
+            if self.mode == "ignore":
+                return True
+            return super().handle_expect_100()
+
+        def log_message(self, format, *args):
+            pass
+
+    def setUp(self):
+        self.Handler.mode = "continue"
+        self.Handler.expects = []
+        self.transport = httpclass.LoopbackTransport(self.Handler)
+        self.client = httpclass.HTTPClient(transport = self.transport, expect_continue = 1000,
+                                           continue_timeout = 0.5)
+        self.data = bytes(range(256)) * 400
+
+    def tearDown(self):
+        self.client.close()
+
+    def testContinue(self):
+        start = time.monotonic()
+        req = self.client.POST("http://upload.test/", body = self.data)
+        self.assertTrue(time.monotonic() - start < 0.4)
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body.encode("ISO-8859-1") == self.data)
+        # Small bodies go straight out, on the same connection
+        req = self.client.POST("http://upload.test/", body = self.data[:999])
+        self.assertTrue(req.body.encode("ISO-8859-1") == self.data[:999])
+        self.assertTrue(self.Handler.expects == ["100-continue"])
+        self.assertTrue(self.transport.connections == 1)
+
+    def testHighDescriptors(self):
+        '''Waiting for the go-ahead works on descriptors past 1024'''
+        held = fill_low_descriptors()
+        try:
+            req = self.client.POST("http://upload.test/", body = self.data)
+            self.assertTrue(req.body.encode("ISO-8859-1") == self.data)
+        finally:
+            for fd in held:
+                os.close(fd)
+
+    def testReject(self):
+        self.Handler.mode = "reject"
+        with tempfile.TemporaryFile() as f:
+            f.write(self.data)
+            f.seek(0)
+            for body in (self.data, f):
+                req = self.client.POST("http://upload.test/", body = body)
+                self.assertTrue(req.code == 413)
+                self.assertTrue(req.timing.bytes_sent < 1000)
+        # The server was left waiting on a body, so each request got its own connection
+        self.assertTrue(self.transport.connections == 2)
+
+    def testIgnored(self):
+        self.Handler.mode = "ignore"
+        start = time.monotonic()
+        req = self.client.POST("http://upload.test/", body = self.data)
+        self.assertTrue(time.monotonic() - start >= 0.5)
+        self.assertTrue(req.body.encode("ISO-8859-1") == self.data)
+
+class TestHeaderLookup(unittest.TestCase):
+    '''Tests header access on parsed responses, no server needed'''
+    raw = ("HTTP/1.1 200 OK\r\n"
+           "Content-Length: 5\r\n"
+           "Set-Cookie: a=1\r\n"
+           "set-cookie: b=2\r\n"
+           "\r\n"
+           "hello")
+
+    def testCaseInsensitiveGet(self):
+        res = httpclass.HTTPResponse.from_str(self.raw)
+        self.assertTrue(res.code == 200)
+        for field in ("Content-Length", "content-length", "CONTENT-LENGTH"):
+            self.assertTrue(res.get(field) == "5", "Missed %s" % field)
+        self.assertTrue(res.get("X-Missing") == None)
+        self.assertTrue("content-length" in res)
+        self.assertTrue("X-Missing" not in res)
+
+    def testRepeatedFields(self):
+        res = httpclass.HTTPResponse.from_str(self.raw)
+        self.assertTrue(res.get("Set-Cookie") == "a=1")
+        self.assertTrue(res.get_all("Set-Cookie") == ["a=1", "b=2"])
+        self.assertTrue(res.get_all("X-Missing") == [])
+
+    def testLenientGrammar(self):
+        '''Responses the parser accepts (no space after the colon, folded lines, no reason phrase) read back too'''
+        heads = {
+            "nospace": "HTTP/1.1 200 OK\r\nContent-Length:5\r\nX-Tight:value \r\n\r\n",
+            "folded": "HTTP/1.1 200 OK\r\nContent-Length: 5\r\nX-Folded: first\r\n \tsecond\r\n\r\n",
+            "noreason": "HTTP/1.1 200\r\nContent-Length: 5\r\n\r\n",
+        }
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    path = line.split(b" ")[1].decode()[1:]
+                    while self.rfile.readline() not in (b"\r\n", b""):
+                        pass
+                    self.wfile.write(heads[path].encode() + b"hello")
+
+        http = httpclass.HTTPClient(transport = httpclass.LoopbackTransport(Handler))
+        responses = {path: http.GET("http://lenient.test/%s" % path) for path in heads}
+        http.close()
+        for path, res in responses.items():
+            self.assertTrue(res.code == 200 and res.body == "hello", path)
+            self.assertTrue(res.get("Content-Length") == "5", path)
+        self.assertTrue(responses["nospace"].get("X-Tight") == "value")
+        self.assertTrue(responses["folded"].get("X-Folded") == "first second")
+        self.assertTrue(responses["noreason"].get("Response") == "")
+        self.assertTrue(responses["noreason"].headers[0].response == "")
+
+    def testLazyParsing(self):
+        '''Headers are parsed on first use, and the status line alone for the status fields'''
+        res = httpclass.HTTPResponse.from_str(self.raw + "\r\n\r\nmore")
+        self.assertTrue(res.code == 200)
+        self.assertTrue(res._headers == None)
+        self.assertTrue(res.body == "hello\r\n\r\nmore")
+        self.assertTrue(res.head() + res.body == self.raw + "\r\n\r\nmore")
+        self.assertTrue(res.get("content-length") == "5")
+        self.assertTrue([str(header) for header in res.headers[1:]] ==
+                        ["Content-Length: 5\r\n", "Set-Cookie: a=1\r\n", "set-cookie: b=2\r\n"])
+        res.add_header(httpclass.StdHeader("X-Added", "1"))
+        self.assertTrue(res.head().endswith("X-Added: 1\r\n\r\n"))
+        self.assertTrue(res.get("Response") == "OK")
+
+    def testTeapot(self):
+        '''A captured header block parses, status line quirks and all'''
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "google_teapot.txt"),
+                  encoding = "utf-8", newline = "") as f:
+            res = httpclass.Response.from_str(f.read())
+        self.assertTrue(res.get("Content-Encoding") == "br")
+        self.assertTrue(res.get("Server") == "gws")
+        self.assertTrue(len(res.headers) == 12)
+        self.assertTrue(res.body.startswith("<!doctype html>"))
+
+    def testSlots(self):
+        for header in (httpclass.StdHeader("a", "b"), httpclass.IntlReqHeader("get", "/", "HTTP/1.1"),
+                       httpclass.IntlResHeader("HTTP/1.1", "200", "OK")):
+            self.assertFalse(hasattr(header, "__dict__"))
+
+class TestResponseParser(unittest.TestCase):
+    '''Feeds the sans-IO parser responses split at random points, no server needed'''
+    body = b"first\r\n\r\nsecond\r\n" + bytes(range(256)) * 4
+
+    def chunked(self, body, size):
+        pieces = [b"%x;ext=1\r\n%s\r\n" % (len(body[i:i + size]), body[i:i + size])
+                  for i in range(0, len(body), size)]
+        return b"".join(pieces) + b"0\r\nX-Trailer: t\r\n\r\n"
+
+    def messages(self):
+        body = self.body
+        return [
+            (b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body, "GET", body, "length"),
+            (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" + self.chunked(body, 7), "GET", body, "chunked"),
+            (b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 201 Created\r\nContent-Length: 4\r\n\r\nmade", "POST", b"made", "length"),
+            (b"HTTP/1.1 304 Not Modified\r\nETag: x\r\n\r\n", "GET", b"", "none"),
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 9\r\n\r\n", "HEAD", b"", "none"),
+        ]
+
+    def parse(self, parser, data, rng):
+        '''Feeds data in random pieces, as bytes or memoryviews. Returns the events with BodyData copied.'''
+        cuts = sorted(rng.sample(range(1, len(data)), min(len(data) - 1, rng.randint(0, 12)))) + [len(data)]
+        events, start = [], 0
+        for cut in cuts:
+            piece = data[start:cut] if rng.random() < 0.5 else memoryview(bytearray(data))[start:cut]
+            for event in parser.feed(piece):
+                events.append(httpclass.BodyData(bytes(event.data)) if type(event) is httpclass.BodyData else event)
+            start = cut
+        return events
+
+    def assertMessage(self, parser, events, body, framing):
+        kinds = [type(event).__name__ for event in events]
+        self.assertTrue(kinds[0] == "StatusLine", kinds)
+        self.assertTrue(kinds[-1] == "EndOfMessage", kinds)
+        self.assertTrue(kinds.count("HeadersComplete") == 1, kinds)
+        self.assertTrue(b"".join(event.data for event in events if type(event) is httpclass.BodyData) == body)
+        self.assertTrue(parser.done and parser.framing == framing)
+
+    def testRandomSplits(self):
+        rng = random.Random(404)
+        for data, method, body, framing in self.messages():
+            for i in range(200):
+                parser = httpclass.ResponseParser(method)
+                events = self.parse(parser, data, rng)
+                self.assertMessage(parser, events, body, framing)
+                self.assertTrue(parser.unconsumed == b"")
+
+    def testUntilEOF(self):
+        rng = random.Random(405)
+        for i in range(100):
+            parser = httpclass.ResponseParser()
+            events = self.parse(parser, b"HTTP/1.0 200 OK\r\n\r\n" + self.body, rng)
+            self.assertFalse(parser.done)
+            events += parser.feed_eof()
+            self.assertMessage(parser, events, self.body, "eof")
+            self.assertFalse(parser.reusable)
+
+    def testPipelined(self):
+        '''Bytes past the end of one response are left for the next parser'''
+        rng = random.Random(406)
+        messages = self.messages()
+        data = b"".join(message[0] for message in messages)
+        for i in range(100):
+            remaining = data
+            for message, method, body, framing in messages:
+                parser = httpclass.ResponseParser(method)
+                events = self.parse(parser, remaining, rng) if remaining else []
+                self.assertMessage(parser, events, body, framing)
+                remaining = parser.unconsumed
+            self.assertTrue(remaining == b"")
+
+    def testEvents(self):
+        parser = httpclass.ResponseParser()
+        events = parser.feed(b"HTTP/1.1 404 Not Found\r\nX-A: 1\r\nx-a:  2 \r\nConnection: close\r\n\r\n")
+        status, first, second, connection, complete = events
+        self.assertTrue((status.version, status.code, status.reason) == (b"HTTP/1.1", 404, b"Not Found"))
+        self.assertTrue((first.field, first.value, second.field, second.value) == (b"X-A", b"1", b"x-a", b"2"))
+        self.assertTrue(complete.framing == "eof" and not complete.reusable)
+        self.assertTrue(complete.head.endswith(b"close\r\n\r\n") and not parser.done)
+
+    def testMalformed(self):
+        for data in (b"HTTP/1.1 2xx OK\r\n\r\n", b"ICY 200 OK\r\n\r\n", b"HTTP/1.1 200 OK\r\nNoColon\r\n\r\n",
+                     b"HTTP/1.1 200 OK\r\nContent-Length: 1, 2\r\n\r\n",
+                     b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n",
+                     b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n1\r\nab\r\n"):
+            self.assertRaises(httpclass.ProtocolError, httpclass.ResponseParser().feed, data)
+        self.assertRaises(httpclass.ProtocolError, httpclass.ResponseParser(max_head = 16).feed, b"HTTP/1.1 200 OK\r\nX: y")
+
+    def testCutShort(self):
+        parser = httpclass.ResponseParser()
+        self.assertTrue(parser.feed_eof() == [] and not parser.started)
+        parser.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc")
+        self.assertRaises(ConnectionError, parser.feed_eof)
+
+class TestRequestSerializer(unittest.TestCase):
+    '''The cached serializer must match Request.from_args byte for byte'''
+
+    def assertSameWire(self, method, url, args = None, body = None):
+        serializer = httpclass.RequestSerializer()
+        while True:
+            expected = httpclass.Request.from_args(method, url, args, body)
+            built = serializer.build(method, url, args, body)
+            # Retry if the clock ticked over a second between the two
+            if expected.get("Date") == built.get("Date"):
+                break
+        self.assertTrue(built.head_bytes() == expected.head().encode("utf-8"))
+        if body is None:
+            self.assertTrue(str(built) == str(expected))
+        for field in ("Method", "Host", "Content-Length", "Content-Type", "User-Agent"):
+            self.assertTrue(built.get(field) == expected.get(field), field)
+
+    def testGET(self):
+        self.assertSameWire("Get", "http://example.com:8080/a/b?x=1")
+        self.assertSameWire("GET", "http://example.com")
+
+    def testPOST(self):
+        self.assertSameWire("POST", "http://example.com/form", {"a": "1 2", "b": "\r\n"})
+        self.assertSameWire("POST", "http://example.com/form", ["a=1", "b=2"])
+        self.assertSameWire("POST", "http://example.com/raw", body = b"raw")
+        self.assertSameWire("POST", "http://example.com/gen", body = iter([b"x"]))
+
 def test_test_webserver():
     print("http://%s:%d/dsadsadsadsa\n" % (BASEHOST,BASEPORT) )
     MyHTTPHandler.get = echo_path_get
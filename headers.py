@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 
 class Header(ABC):
+    #Headers are small and numerous, so none of them carry a __dict__
+    __slots__ = ()
+
     @abstractmethod
     def from_str(cls, data: str):
         '''Constructs a header object from its string representation.'''
@@ -17,10 +20,15 @@ class Header(ABC):
         raise NotImplementedError
 
 class StdHeader(Header):
+    __slots__ = ('field', 'value')
+
     @classmethod
     def from_str(cls, data: str):
-        key, value = data.split(': ', maxsplit = 1)
-        return cls(key, value)
+        #Whitespace around the value is optional (RFC 7230 3.2)
+        key, colon, value = data.partition(':')
+        if not colon:
+            raise ValueError(f'Malformed header line {data!r}')
+        return cls(key.strip(), value.strip())
 
     def __init__(self, field: str, value: str):
         self.field = field
@@ -33,6 +41,8 @@ class StdHeader(Header):
         return f'{self.field}: {self.value}\r\n'
 
 class IntlReqHeader(Header):
+    __slots__ = ('method', 'path', 'scheme')
+
     @classmethod
     def from_str(cls, data: str):
         method, path, scheme = data.split(' ')
@@ -50,11 +60,13 @@ class IntlReqHeader(Header):
         return f'{self.method} {self.path} {self.scheme}\r\n'
 
 class IntlResHeader(Header):
+    __slots__ = ('scheme', 'code', 'response')
+
     @classmethod
     def from_str(cls, data: str):
-        #Accomodate for code messages with multiple words (e.g Bad Request)
-        scheme, code, response = data.split(' ', maxsplit = 2)
-        return cls(scheme, code, response)
+        #Accomodate for code messages with multiple words (e.g Bad Request), or none at all
+        scheme, code, *response = data.split(' ', maxsplit = 2)
+        return cls(scheme, code, response[0] if response else '')
 
     def __init__(self, scheme: str, code: str, response: str):
         self.scheme = scheme
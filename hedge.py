@@ -0,0 +1,87 @@
+import socket
+import threading
+from collections import deque
+
+class AttemptCancelled(Exception):
+    '''A copy of a hedged request was abandoned because the other copy answered first.'''
+
+class HedgePolicy(object):
+    '''Decides when a slow idempotent request gets a duplicate sent alongside it (a hedged request).
+
+    The delay is the percentile of recently observed latencies, so only about the slowest
+    (1 - percentile) of requests are hedged. Until min_samples latencies have been recorded
+    initial_delay is used instead. The delay is always kept within [min_delay, max_delay].
+    '''
+
+    #Recorded latencies between recomputations of the delay
+    REFRESH = 32
+
+    def __init__(self, percentile: float = 0.95, initial_delay: float = 0.05, min_delay: float = 0.001,
+                 max_delay: float = 1.0, window: int = 1000, min_samples: int = 20):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedged = 0
+        #Requests whose duplicate answered first
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen = window)
+        self._delay = initial_delay
+        self._since_refresh = 0
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        '''Seconds to wait for an answer before sending the duplicate.'''
+        return self._delay
+
+    def record(self, seconds: float, hedged: bool = False, hedge_won: bool = False):
+        '''Notes how long a request took to answer, and whether a duplicate was sent and won.'''
+        with self._lock:
+            self.requests += 1
+            self.hedged += hedged
+            self.hedge_wins += hedge_won
+            self._latencies.append(seconds)
+            self._since_refresh += 1
+            if self._since_refresh < self.REFRESH or len(self._latencies) < self.min_samples:
+                return
+            self._since_refresh = 0
+            ordered = sorted(self._latencies)
+        delay = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        self._delay = min(self.max_delay, max(self.min_delay, delay))
+
+    @property
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'hedged': self.hedged, 'hedge_wins': self.hedge_wins,
+                'delay': self._delay}
+
+class Attempt(object):
+    '''One copy of a hedged request. Remembers the connection it runs on, so that the losing copy
+    can be cancelled by shutting its socket down under it.'''
+
+    def __init__(self):
+        self.conn = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def attach(self, conn) -> bool:
+        '''Notes the connection the copy is about to use. False if the copy was cancelled already.'''
+        with self._lock:
+            self.conn = conn
+            return not self.cancelled
+
+    def detach(self):
+        '''Forgets the connection before it goes back to the pool, where another request may take it.'''
+        with self._lock:
+            self.conn = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conn = self.conn
+            if conn is not None:
+                try:
+                    conn.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
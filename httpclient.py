@@ -18,16 +18,53 @@
 # Write your own HTTP GET and POST
 # The point is to understand what you have to send and get experience with it
 
+import argparse
 import sys
+import threading
 import socket
 import re
+import time
+import os
+import mmap
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 # you may use urllib to encode data appropriately
 import urllib.parse as parse
 from socketr import *
+from pool import Connection, ConnectionPool, ConnectionClosed
+from pool import HTTPTimeout, ConnectTimeout, ReadTimeout, DeadlineExceeded
+from stream import BodyStream
+from resolver import Resolver
+from transport import Transport, TCPTransport, UnixTransport, LoopbackTransport
+from cache import HTTPCache
+from decoder import get_decoder, MAX_DECODED_SIZE, ContentDecodingError, DecompressionBombError
+from timing import Timing
+from hedge import HedgePolicy, Attempt, AttemptCancelled
+from redirect import RedirectCache, TooManyRedirects, redirect_target, redirected_request, PERMANENT_CODES
+from download import Progress, DownloadError, split_ranges, validator, CONTENT_RANGE, DOWNLOAD_BLOCK_SIZE, PROGRESS_SUFFIX
+
+#Bytes read per block when streaming a file request body
+UPLOAD_BLOCK_SIZE = 64 * 1024
+
+#Events HTTPClient hooks can be registered for
+HOOK_EVENTS = ('on_request', 'on_response', 'on_connect', 'on_error')
+
+#Most bytes set aside for a body up front on the word of its Content-Length, past which it grows as bytes arrive
+BODY_PREALLOCATE_SIZE = 16 * 1024 * 1024
+
+#Threads available to run the copies of hedged requests
+HEDGE_WORKERS = 64
+
+#POST bodies at least this long are held back behind Expect: 100-continue
+EXPECT_CONTINUE_SIZE = 1024 * 1024
+
+#Methods that can be transparently re-sent if a reused connection dies before answering
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
 
 def help():
     print('''
-    httpclient.py [GET/POST] [URL] [*Args(Optional)]
+    httpclient.py [options] [GET/POST] [URL] [*Args(Optional)]
     
     Args is a list of values to POST, and URL is a proper url following an HTTP 1.1 scheme
 
@@ -35,77 +72,621 @@ def help():
          "... www.mysitehere.co.nz/" is not.
 
     It is possible (but not recommended by HTTP conventions) to post with no body and get with a body.
+
+    Any of these options turns on load-test mode, which sends the request repeatedly and prints a summary:
+        -n, --requests N      send N requests in total
+        -d, --duration SECS   keep sending for SECS seconds (stops at whichever of -n/-d comes first)
+        -c, --concurrency N   keep N requests in flight at once (default 1)
+        -p, --processes N     spread the concurrency over N worker processes (default 1)
     ''')
 
 class HTTPResponse(Response):
-    def __init__(self, headers, body):
-        super().__init__(headers, body)
+    def __init__(self, headers = None, body = None, raw_head = None):
+        super().__init__(headers, body, raw_head)
         self.code = int(self.get('Code'))
+        #Timing of the request that produced this response, None when it didn't come off the network
+        self.timing = None
+        #Redirect responses followed on the way to this one, oldest first
+        self.history = []
 
 class HTTPClient(object):
+    def __init__(self, max_per_host: int = 10, max_idle: int = 4, idle_timeout: float = 30.0,
+                 pipeline_depth: int = 1, resolver: Resolver = None, cache: HTTPCache = None,
+                 decode_content: bool = True, max_decoded_size: int = MAX_DECODED_SIZE, hooks: dict = None,
+                 connect_timeout: float = None, read_timeout: float = None, deadline: float = None,
+                 hedge: HedgePolicy = None, max_redirects: int = 10, redirects: RedirectCache = None,
+                 transport: Transport = None, expect_continue: int = EXPECT_CONTINUE_SIZE,
+                 continue_timeout: float = 1.0):
+        #POST bodies of at least expect_continue bytes (None for never) wait for the server's go-ahead, for
+        #up to continue_timeout seconds, so one it will reject anyway (e.g 401, 413) isn't uploaded for nothing
+        self.expect_continue = expect_continue
+        self.continue_timeout = continue_timeout
+        #Redirects followed per request (0 returns 3xx responses as they are), and the cache of permanent ones
+        self.max_redirects = max_redirects
+        self.redirects = redirects if redirects is not None else RedirectCache()
+        #Seconds allowed to open a connection, to wait on an open one, and for a whole request (None for no limit)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        #Optional policy sending a duplicate of GETs that are slow to answer
+        self.hedge = hedge
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        #gzip/deflate bodies are decoded unless decode_content is off, up to max_decoded_size bytes
+        self.decode_content = decode_content
+        self.max_decoded_size = max_decoded_size
+        #Optional HTTP cache consulted by GET, None to always go to the network
+        self.cache = cache
+        #Cached name resolution, replaceable with a stub to run offline
+        self.resolver = resolver if resolver is not None else Resolver()
+        #URL scheme -> how its origins are reached, http over TCP unless another transport is given
+        self.transports = {
+            'http': transport if transport is not None else TCPTransport(self.resolver),
+            'http+unix': UnixTransport(),
+        }
+        #Persistent connections per (host, port), checked out for each request
+        self.pool = ConnectionPool(self.connect, max_per_host, max_idle, idle_timeout)
+        #Requests pipeline() keeps unanswered on one connection, 1 means strict request/response
+        self.pipeline_depth = pipeline_depth
+        self.serializer = RequestSerializer()
+        #Event -> callbacks, see add_hook
+        self.hooks = {event: [] for event in HOOK_EVENTS}
+        for event, callbacks in (hooks or {}).items():
+            for callback in (callbacks if isinstance(callbacks, (list, tuple)) else [callbacks]):
+                self.add_hook(event, callback)
+
+    def add_hook(self, event: str, callback):
+        '''Registers callback to be called on event, in registration order:
+            on_request(request)            before each attempt at sending a request
+            on_connect(host, port, timing) once a new connection is open
+            on_response(request, response) once a response's headers (and unless streaming, body) are in
+            on_error(request, exception)   when a request fails
+        Exceptions raised by a callback propagate to the caller of the request.'''
+        if event not in self.hooks:
+            raise ValueError(f'Unknown hook event {event!r}, expected one of {", ".join(HOOK_EVENTS)}')
+        self.hooks[event].append(callback)
+
+    def _emit(self, event: str, *args):
+        for callback in self.hooks[event]:
+            callback(*args)
+
     def get_host_port(self, url: str):
-        '''Returns a host, pair tuple'''
+        '''Returns a host, port tuple from a url's host part, without the brackets of an IPv6 literal.
+        The percent-encoded socket path of an http+unix url
+        (e.g http+unix://%2Frun%2Fapp.sock/path) comes back as the host, with None for the port.'''
 
-        split_url = url.split(':')
-        host = split_url[0]
-        try:
-            port = int(split_url[1])
-        except IndexError:
+        if url[:3].lower() == '%2f':
+            return (parse.unquote(url), None)
+        #urlsplit knows IPv6 literals are bracketed (e.g [::1]:8080), and .port rejects a bad port with ValueError
+        split_url = parse.urlsplit('//' + url)
+        port = split_url.port
+        if port is None:
             port = 80 #Default per HTTP spec.
-        return (host, port)
+        return (split_url.hostname, port)
+
+    def connect(self, host, port, timing: Timing = None, deadline: float = None, scheme: str = 'http') -> socket.socket:
+        '''Opens a connection with the transport for scheme, allowing it connect_timeout
+        (and no longer than deadline allows). The returned socket has read_timeout set.
+        The resolve and connect times are recorded on timing, if given.'''
+        transport = self.transports.get(scheme)
+        if transport is None:
+            raise ValueError(f'No transport for {scheme or "scheme-less"} urls, expected one of {", ".join(self.transports)}')
+        if timing is not None:
+            #Only TCP has names to resolve, it overwrites these
+            timing.resolve_start = timing.resolve_end = time.monotonic()
+        sock = transport.connect(host, port, self.connect_timeout, deadline, timing)
+        sock.settimeout(self.read_timeout)
+        if timing is not None:
+            timing.connect_end = time.monotonic()
+        self._emit('on_connect', host, port, timing)
+        return sock
+
+    def _deadline(self) -> float:
+        '''When a request starting now must be done by, as a time.monotonic() value.'''
+        return None if self.deadline is None else time.monotonic() + self.deadline
+
+    def sendall(self, conn: Connection, data: bytes):
+        conn.sendall(data)
+
+    def sendmsg(self, conn: Connection, buffers: list):
+        conn.sendmsg(buffers)
+
+    def send_request(self, conn: Connection, request: Request, with_head: bool = True):
+        '''Writes request to conn. The head goes out in the same gather write as the body (or its first
+        block), never joined to it in a copy. Regular files opened in binary mode are sent with sendfile,
+        other file and iterable bodies are streamed in blocks, chunk-framed when their length isn't known,
+        so they never have to fit in memory. Without with_head only the body is sent, its head having
+        gone ahead with Expect: 100-continue.'''
+        head = request.head_bytes() if with_head else b''
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            self.sendmsg(conn, [head, body])
+            return
+
+        chunked = request.get('Transfer-Encoding') == 'chunked'
+        #A known length on a file body means body_length found it to be a regular file
+        if not chunked and hasattr(body, 'fileno') and 'b' in getattr(body, 'mode', 'b'):
+            if head:
+                self.sendall(conn, head)
+            conn.sendfile(body, int(request.get('Content-Length')))
+            return
+        #Buffers waiting to go out with the next block, starting with the head
+        pending = [head]
+        blocks = iter(lambda: body.read(UPLOAD_BLOCK_SIZE), b'') if hasattr(body, 'read') else body
+        for block in blocks:
+            if isinstance(block, str):
+                block = block.encode('utf-8')
+            if not block:
+                #Text files signal EOF with '', and an empty chunk would end the body early
+                if hasattr(body, 'read'):
+                    break
+                continue
+            if chunked:
+                pending.extend((b'%x\r\n' % len(block), block, b'\r\n'))
+            else:
+                pending.append(block)
+            self.sendmsg(conn, pending)
+            pending = []
+        if chunked:
+            pending.append(b'0\r\n\r\n')
+        if pending:
+            self.sendmsg(conn, pending)
 
-    def connect(self, host, port):
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((host, port))
-        except:
-            print(f'Connection to {host}:{port} could not be made.')
-            self.close()
-            sys.exit(1)
-        return None
-
-    def sendall(self, data):
-        encoded_data = data.encode('utf-8')
-        self.socket.sendall(encoded_data)
-        
     def close(self):
-        self.socket.close()
-
-    # read everything from the socket
-    def recvall(self):
-        buffer = bytearray()
-        done = False
-        while not done:
-            part = self.socket.recv(1024)
-            if (part):
-                buffer.extend(part)
+        '''Closes every idle pooled connection, and stops the threads running hedged requests.'''
+        self.pool.close()
+        with self._hedge_lock:
+            executor, self._hedge_executor = self._hedge_executor, None
+        if executor is not None:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    def recv_body(self, conn: Connection, parser: ResponseParser, events: list) -> bytes:
+        '''Reads the rest of the body parser is in, after the events that came with its head, into one buffer.
+        Bodies framed by length or EOF are read straight into place, chunked ones are moved down over their framing.'''
+        pending = b''.join([event.data for event in events if type(event) is BodyData])
+        if parser.done:
+            return pending
+        if parser.framing == 'length':
+            #A server can declare any length, so only so much of it is taken on trust
+            body = bytearray(len(pending) + min(parser.remaining, BODY_PREALLOCATE_SIZE))
+        else:
+            body = bytearray(max(conn.read_size, 2 * len(pending)))
+        body[:len(pending)] = pending
+        used = len(pending)
+        while not parser.done:
+            if len(body) - used < conn.read_size:
+                #Grow geometrically so many small reads stay linear, never past a declared length
+                grow = max(conn.read_size, len(body))
+                if parser.framing == 'length':
+                    grow = min(grow, used + parser.remaining - len(body))
+                if grow > 0:
+                    body.extend(bytes(grow))
+            with memoryview(body) as view:
+                used += self._recv_body_into(conn, parser, view, used)
+        del body[used:]
+        return body
+
+    @staticmethod
+    def _recv_body_into(conn: Connection, parser: ResponseParser, view: memoryview, used: int) -> int:
+        '''One read of body bytes into view[used:], returning how many it added.'''
+        if parser.framing == 'length':
+            region = view[used:used + parser.remaining]
+        else:
+            region = view[used:]
+        added = 0
+        for event in conn.feed(parser, region):
+            if type(event) is BodyData:
+                count = len(event.data)
+                if parser.framing == 'chunked':
+                    view[used + added:used + added + count] = event.data
+                added += count
+        return added
+
+    def recvall(self, conn: Connection, method: str) -> tuple:
+        '''Reads exactly one response off conn, framed by Content-Length, chunked encoding or EOF.
+        Returns the head, the body and whether conn can carry another request.'''
+        parser = ResponseParser(method)
+        complete, events = conn.read_head(parser)
+        return (complete.head, self.recv_body(conn, parser, events), complete.reusable)
+
+    def content_decoder(self, head: bytes):
+        '''Returns a decoder undoing the response's gzip/deflate Content-Encoding, or None to keep the body as sent.'''
+        if not self.decode_content:
+            return None
+        return get_decoder(self._head_fields(head).get('content-encoding'), self.max_decoded_size)
+
+    def decode(self, head: bytes, body: bytes) -> bytes:
+        '''Undoes the Content-Encoding of a buffered body, if decode_content is on.'''
+        decoder = self.content_decoder(head)
+        if decoder is None:
+            return body
+        return decoder.decompress(body) + decoder.flush()
+
+    @staticmethod
+    def _head_fields(head: bytes) -> dict:
+        '''Lower-cased field -> value mapping of a raw response head, for content decoding.'''
+        fields = {}
+        for line in head.decode('ISO-8859-1').split('\r\n')[1:]:
+            if ':' in line:
+                field, value = line.split(':', 1)
+                fields[field.strip().lower()] = value.strip()
+        return fields
+
+    def communicate_r(self, host, port, data: Request, stream: bool = False, deadline: float = None,
+                      attempt: Attempt = None) -> HTTPResponse:
+        '''Sends a request on a pooled connection and returns the response, with its Timing attached.
+        A reused connection found dead before answering is discarded and the request retried on another.
+        With stream, the response is returned once its headers are in and its body is a BodyStream.
+        deadline (a time.monotonic() value) bounds the whole exchange, up to the headers when streaming.
+        attempt, when the request is one copy of a hedged request, tracks its connection for cancelling.'''
+
+        try:
+            return self._communicate(host, port, data, stream, deadline, attempt)
+        except Exception as e:
+            #The abandoned copy of a hedged request failing is expected, not an error
+            if attempt is None or not attempt.cancelled:
+                self._emit('on_error', data, e)
+            raise
+
+    def _communicate(self, host, port, data: Request, stream: bool, deadline: float, attempt: Attempt) -> HTTPResponse:
+        method = data.get('Method')
+        while True:
+            self._emit('on_request', data)
+            timing = Timing()
+            conn = self.pool.acquire(host, port, timing, deadline, data.url_scheme)
+            if attempt is not None and not attempt.attach(conn):
+                self.pool.discard(conn)
+                raise AttemptCancelled('The other copy of this hedged request answered first')
+            conn.set_deadline(deadline)
+            timing.reused = conn.reused
+            sent_before, received_before = conn.bytes_sent, conn.bytes_received
+            conn.first_byte_at = None
+            sent = False
+            try:
+                parser = ResponseParser(method)
+                final = None
+                expect = data.get('Expect') == '100-continue'
+                if expect:
+                    self.sendall(conn, data.head_bytes())
+                    final = conn.await_continue(parser, self.continue_timeout)
+                if final is None:
+                    self.send_request(conn, data, not expect)
+                sent = True
+                timing.request_sent = time.monotonic()
+                complete, events = final if final is not None else conn.read_head(parser)
+                head, reusable = complete.head, complete.reusable
+                if final is not None:
+                    #Answered before the body went out, the server may still be waiting for it
+                    reusable = parser.reusable = False
+                #Bytes already buffered from an earlier read count as arriving now
+                timing.first_byte = conn.first_byte_at or time.monotonic()
+                if stream:
+                    decoder = self.content_decoder(head)
+                    self._finish_exchange(conn, timing, sent_before, received_before)
+                    #The stream hands conn back to the pool once the body is consumed, straight away when
+                    #it is empty, after which another request may be using it
+                    body = BodyStream(conn, parser, events, self.pool, decoder, timing)
+                else:
+                    #Some bytes (i.e continuation) cannot be read with utf-8
+                    body = self.decode(head, self.recv_body(conn, parser, events)).decode('ISO-8859-1')
+                    timing.last_byte = time.monotonic()
+            except ConnectionClosed:
+                self.pool.discard(conn)
+                if conn.reused and method in IDEMPOTENT_METHODS and data.replayable:
+                    continue
+                raise
+            except (BrokenPipeError, ConnectionResetError):
+                self.pool.discard(conn)
+                #A streamed body may be partly consumed, so it can't be sent again
+                if conn.reused and not sent and data.replayable:
+                    continue
+                raise
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+            if not stream:
+                self._finish_exchange(conn, timing, sent_before, received_before)
+                if attempt is not None:
+                    attempt.detach()
+                self.pool.release(conn, reusable)
+            response = HTTPResponse.from_head(head.decode('ISO-8859-1'), body)
+            response.timing = timing
+            self._emit('on_response', data, response)
+            return response
+
+    @staticmethod
+    def _finish_exchange(conn: Connection, timing: Timing, sent_before: int, received_before: int):
+        '''Records the bytes a request moved and lifts its deadline off conn, while conn is still its own.'''
+        timing.bytes_sent = conn.bytes_sent - sent_before
+        timing.bytes_received = conn.bytes_received - received_before
+        conn.set_deadline(None)
+
+    def pipeline(self, urls: list) -> list:
+        '''GETs urls from a single origin, writing up to pipeline_depth requests back-to-back on one
+        connection before reading their responses in order. Returns the responses in url order.
+        Requests left unanswered when the server closes are replayed on a new connection, falling
+        back to strict request/response if the server dropped the connection mid-pipeline.'''
+
+        pending = deque(self.serializer.build("Get", url, None) for url in urls)
+        if len({(request.url_scheme, request.get("Host")) for request in pending}) > 1:
+            raise ValueError('Pipelined requests must share one origin')
+        if not pending:
+            return []
+        host, port = self.get_host_port(pending[0].get("Host"))
+        depth = max(1, self.pipeline_depth)
+        responses = []
+
+        while pending:
+            conn = self.pool.acquire(host, port, scheme = pending[0].url_scheme)
+            in_flight = deque()
+            reusable = True
+            answered = 0
+            try:
+                while reusable and (pending or in_flight):
+                    #Keep the pipeline topped up to the configured depth
+                    while pending and len(in_flight) < depth:
+                        request = pending.popleft()
+                        in_flight.append(request)
+                        self.send_request(conn, request)
+                    head, body, reusable = self.recvall(conn, 'GET')
+                    in_flight.popleft()
+                    answered += 1
+                    body = self.decode(head, body)
+                    responses.append(HTTPResponse.from_head(head.decode('ISO-8859-1'), body.decode('ISO-8859-1')))
+            except (ConnectionClosed, BrokenPipeError, ConnectionResetError):
+                self.pool.discard(conn)
+                #A fresh connection that answers nothing to a lone request won't do better on a retry
+                if not answered and not conn.reused and depth == 1:
+                    raise
+                #Responses queued behind a reset can be lost, so replay one request at a time
+                depth = 1
+            except BaseException:
+                self.pool.discard(conn)
+                raise
             else:
-                done = not part
-        #Some bytes (i.e continuation, gzip) cannot be read with utf-8
-        return buffer.decode('ISO-8859-1')
-
-    def communicate_r(self, host, port, data: Request) -> HTTPResponse:
-        '''Opens and requests on a socket, returns the response and closes socket.'''
-        
-        self.connect(host, port)
-        self.sendall(str(data))
-        response = HTTPResponse.from_str(self.recvall())
-        self.close()
-        return response
-
-    def GET(self, url: str, args = None) -> HTTPResponse:
-        request = Request.from_args("Get", url, args)
-        host, port = self.get_host_port(request.get("Host"))
-        response = self.communicate_r(host, port, request)
+                self.pool.release(conn, reusable and not in_flight)
+            #Unanswered requests go back to the front of the queue, in order
+            pending.extendleft(reversed(in_flight))
+
+        return responses
+
+    def GET(self, url: str, args = None, stream: bool = False) -> HTTPResponse:
+        '''With stream, returns as soon as the headers are parsed; the body is then a BodyStream.'''
+        return self._follow("GET", url, args, None, stream)
 
-        return response
+    def POST(self, url: str, args = None, body = None, file = None) -> HTTPResponse:
+        '''body, if given, is sent instead of the form-encoded args: bytes-like, a file object or an
+        iterable of chunks. Bodies of unknown length (e.g generators) are sent chunked.
+        file, a path or a binary file object, is uploaded as the body. Regular files go out with
+        sendfile straight from the page cache, anything else (e.g a pipe) is read in blocks.'''
+        if file is None or hasattr(file, 'read'):
+            return self._follow("POST", url, args, body if file is None else file, False)
+        with open(file, 'rb') as f:
+            return self._follow("POST", url, args, f, False)
 
-    def POST(self, url: str, args = None) -> HTTPResponse:
-        request = Request.from_args("POST", url, args)
+    def _follow(self, method: str, url: str, args, body, stream: bool) -> HTTPResponse:
+        '''Sends a request and follows the redirects it gets, up to max_redirects hops.
+        Hops to the same origin go out on the connection the redirect came back on, and known
+        permanent redirects are taken without asking the server again. The final response keeps
+        the redirects that led to it in history.'''
+        deadline = self._deadline()
+        history = []
+        for hops in range(self.max_redirects + 1):
+            #A GET's args change its query, which a cached redirect of the bare url says nothing about
+            cacheable = self.redirects is not None and self.max_redirects > 0 and (method != "GET" or not args)
+            cached = self.redirects.lookup(url) if cacheable else None
+            if cached is not None:
+                code, target = cached
+            else:
+                response = self._hop(method, url, args, body, stream, deadline)
+                code = response.code
+                target = redirect_target(url, code, response.get('Location'))
+                #A streamed body is used up, so it can't be sent on to a 307/308 target
+                replayable = body is None or isinstance(body, (str, bytes, bytearray, memoryview))
+                if target is None or not self.max_redirects or (code in (307, 308) and not replayable):
+                    response.history = history
+                    return response
+                if stream:
+                    #Read to the end so the connection can carry the next hop
+                    response.body.read()
+                if cacheable and code in PERMANENT_CODES:
+                    self.redirects.store(url, code, target)
+                history.append(response)
+            method, args, body = redirected_request(code, method, args, body)
+            url = target
+        raise TooManyRedirects(f'More than {self.max_redirects} redirects, last to {url}')
+
+    def _hop(self, method: str, url: str, args, body, stream: bool, deadline: float) -> HTTPResponse:
+        '''Sends one request, without following redirects.'''
+        request = self.serializer.build(method, url, args, body)
         host, port = self.get_host_port(request.get("Host"))
-        response = self.communicate_r(host, port, request)
+        if method == "POST":
+            length = request.get('Content-Length')
+            if self.expect_continue is not None and length is not None and int(length) >= self.expect_continue:
+                request.add_header(StdHeader('Expect', '100-continue'))
+            response = self.communicate_r(host, port, request, deadline = deadline)
+            if self.cache is not None and response.code < 400:
+                #The POST may have changed the resource, so cached copies can't be trusted
+                self.cache.invalidate(request.get("Host"), request.get("Path"))
+            return response
+        if stream:
+            return self.communicate_r(host, port, request, True, deadline)
+        if self.cache is not None:
+            return self.cache.fetch(request, lambda request: self._send(host, port, request, deadline),
+                                    HTTPResponse.from_head)
+        return self._send(host, port, request, deadline)
+
+    def _send(self, host, port, request: Request, deadline: float) -> HTTPResponse:
+        '''communicate_r, hedged when there is a hedge policy and the request is safe to send twice.'''
+        if self.hedge is not None and request.get('Method') in IDEMPOTENT_METHODS and request.replayable:
+            return self._hedged(host, port, request, deadline)
+        return self.communicate_r(host, port, request, deadline = deadline)
+
+    def _hedged(self, host, port, request: Request, deadline: float) -> HTTPResponse:
+        '''Sends request and, if no answer has come after the hedge policy's delay, a duplicate of it
+        on another connection. The first copy to answer wins and the other is cancelled.
+        A failed copy only fails the request once the other copy has failed too.'''
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(HEDGE_WORKERS)
+        start = time.monotonic()
+        attempts = {}
+
+        def submit() -> set:
+            attempt = Attempt()
+            future = self._hedge_executor.submit(self.communicate_r, host, port, request, False, deadline, attempt)
+            attempts[future] = attempt
+            return {future}
+
+        first = submit()
+        done, pending = wait(first, timeout = self.hedge.delay())
+        hedged = not done
+        if hedged:
+            pending |= submit()
+
+        errors = []
+        while True:
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                for loser in pending:
+                    #A copy that finished since has handed its connection back, which is no longer its to cancel
+                    if not loser.done():
+                        loser.cancel()
+                        attempts[loser].cancel()
+                self.hedge.record(time.monotonic() - start, hedged, future not in first)
+                return future.result()
+            if not pending:
+                raise errors[0]
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
 
-        return response
+    def download(self, url: str, path: str, segments: int = 4) -> int:
+        '''Saves the resource at url to path, returning its length in bytes.
+
+        When a HEAD shows the server takes byte ranges of a known length, the file is preallocated and
+        split into up to segments ranges fetched in parallel, each on its own connection, and read
+        straight into a memory map of the file. Progress is kept in a sidecar file next to path, so
+        calling download again after an interruption only fetches what is missing, provided the
+        resource's length and validator (ETag or Last-Modified) haven't changed.
+        Other servers get a plain GET, streamed to path. Error statuses raise DownloadError.'''
+        deadline = self._deadline()
+        url, probe = self._probe(url, deadline)
+        length = probe.get('Content-Length')
+        #Ranges of an encoded body are of the encoding, which only decodes as a whole
+        if (probe.code != 200 or probe.get('Accept-Ranges') != 'bytes' or length is None
+                or probe.get('Content-Encoding') is not None):
+            return self._download_stream(url, path)
+
+        length, tag = int(length), validator(probe)
+        progress_path = path + PROGRESS_SUFFIX
+        progress = None
+        if os.path.exists(path) and os.path.getsize(path) == length:
+            progress = Progress.load(progress_path, url, length, tag)
+        if progress is None:
+            progress = Progress(progress_path, url, length, tag, split_ranges(length, segments))
+            with open(path, 'wb') as f:
+                f.truncate(length)
+                try:
+                    #Reserves the blocks up front, so the file isn't fragmented and a full disk shows now
+                    os.posix_fallocate(f.fileno(), 0, length)
+                except (AttributeError, OSError):
+                    pass
+        if not length:
+            progress.remove()
+            return 0
+
+        progress.save()
+        with open(path, 'r+b') as f, mmap.mmap(f.fileno(), length) as output:
+            with memoryview(output) as view:
+                pending = [segment for segment in progress.segments if segment[1] < segment[2]]
+                with ThreadPoolExecutor(max(1, len(pending))) as executor:
+                    futures = [executor.submit(self._fetch_segment, url, segment, view, progress, output, deadline)
+                               for segment in pending]
+                #Every thread has stopped, so the record can be brought up to date, failed or not
+                output.flush()
+                progress.save()
+                errors = [future.exception() for future in futures if future.exception() is not None]
+                for error in errors:
+                    #Their frames hold slices of the map, which can't be closed while any are left
+                    while error is not None:
+                        traceback.clear_frames(error.__traceback__)
+                        error = error.__context__
+        if errors:
+            raise errors[0]
+        progress.remove()
+        return length
+
+    def _probe(self, url: str, deadline: float) -> tuple:
+        '''HEADs url, following redirects. Returns the final url and its response.'''
+        for hops in range(self.max_redirects + 1):
+            request = self.serializer.build('HEAD', url, None)
+            host, port = self.get_host_port(request.get('Host'))
+            response = self.communicate_r(host, port, request, deadline = deadline)
+            target = redirect_target(url, response.code, response.get('Location'))
+            if target is None or not self.max_redirects:
+                return (url, response)
+            url = target
+        raise TooManyRedirects(f'More than {self.max_redirects} redirects, last to {url}')
+
+    def _fetch_segment(self, url: str, segment: list, view: memoryview, progress: Progress, output, deadline: float):
+        '''Fetches the rest of a [start, next, end] segment into its place in view, moving next along as bytes land.'''
+        start, position, end = segment
+        request = self.serializer.build('GET', url, None)
+        request.add_header(StdHeader('Range', f'bytes={position}-{end - 1}'))
+        if progress.validator is not None:
+            #A changed resource comes back whole (200) rather than as a range of the new version
+            request.add_header(StdHeader('If-Range', progress.validator))
+        host, port = self.get_host_port(request.get('Host'))
+        response = self.communicate_r(host, port, request, True, deadline)
+        with response.body as body:
+            match = CONTENT_RANGE.fullmatch((response.get('Content-Range') or '').strip())
+            if (response.code != 206 or match is None or response.get('Content-Encoding') is not None
+                    or (int(match[1]), int(match[2]), int(match[3])) != (position, end - 1, progress.length)):
+                raise DownloadError(f'{url} answered {response.code} to a request for bytes {position}-{end - 1}, '
+                                    'it may have changed since the download started')
+            while position < end:
+                with view[position:min(end, position + DOWNLOAD_BLOCK_SIZE)] as region:
+                    received = body.readinto(region)
+                if not received:
+                    raise ConnectionClosed(f'{url} closed the connection at byte {position} of {start}-{end - 1}')
+                position += received
+                segment[1] = position
+                progress.checkpoint(output)
+
+    def _download_stream(self, url: str, path: str) -> int:
+        '''Saves url to path over one connection, for servers that don't take ranges.'''
+        response = self.GET(url, stream = True)
+        with response.body as body:
+            if response.code != 200:
+                raise DownloadError(f'{url} answered {response.code}')
+            #A ranged download of an earlier version can't be resumed any more
+            Progress(path + PROGRESS_SUFFIX, url, 0, None, []).remove()
+            return body.save(path)
+
+    def fetch_many(self, requests, max_workers: int = 8, ordered: bool = False):
+        '''Runs requests on a pool of threads, yielding (request, response) pairs as they complete.
+
+        Each request is a url to GET or a (method, url[, args]) tuple. Workers check out their own
+        pooled connections. A request that fails yields its exception in place of the response.
+        ordered yields in input order instead of completion order.'''
+
+        def fetch(request):
+            if isinstance(request, str):
+                return self.GET(request)
+            method, url, *args = request
+            return self.command(method, url, args[0] if args else None)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(fetch, request): request for request in requests}
+            for future in (futures if ordered else as_completed(futures)):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    response = e
+                yield (futures[future], response)
 
     def command(self, command: str, url: str, args: list):
         if (command == "POST"):
@@ -114,24 +695,40 @@ class HTTPClient(object):
             return self.GET(url, args)
     
 if __name__ == "__main__":
-    client = HTTPClient()
-    #Expected input: name.py [Method] [URL] [*args]
-    clargs = sys.argv
+    #Expected input: name.py [options] [Method] [URL] [*args]
+    parser = argparse.ArgumentParser(add_help = False)
+    parser.add_argument('method')
+    parser.add_argument('url')
+    parser.add_argument('args', nargs = '*')
+    parser.add_argument('-n', '--requests', type = int)
+    parser.add_argument('-c', '--concurrency', type = int, default = 1)
+    parser.add_argument('-d', '--duration', type = float)
+    parser.add_argument('-p', '--processes', type = int, default = 1)
 
     try:
-        #Don't count name.py as argument to not confuse user.
-        if len(clargs) == 3:
-            method, url = clargs[1:]
-            args = None
-        elif len(clargs == 4):
-            method, url, *args = clargs[1:]
-        else:
-            raise Exception("Incorrect amount of arguments. Expected: 2 or 3")
+        opts = parser.parse_args(sys.argv[1:])
+        method = opts.method.upper()
+        args = opts.args or None
+        assert method in ("GET", "POST"), "Method must be either GET or POST"
 
-        assert method.upper() in ("GET", "POST"), "Method must be either GET or POST"
-        response = client.command(method, url, args)
-        print(response)
+        if opts.requests is None and opts.duration is None and opts.concurrency == 1 and opts.processes == 1:
+            response = HTTPClient().command(method, opts.url, args)
+            print(response)
+        else:
+            import loadgen
+            #Every worker process keeps at least one request in flight
+            concurrency = max(opts.concurrency, opts.processes)
+            requests = opts.requests
+            if requests is None and opts.duration is None:
+                #Only a concurrency or process count given, send one request per concurrent slot
+                requests = concurrency
+            result = loadgen.run(method, opts.url, args, requests, concurrency, opts.duration, opts.processes)
+            print(loadgen.summary(result))
 
+    except SystemExit:
+        #argparse has already said what was wrong with the arguments
+        help()
+        sys.exit(1)
     except Exception as e:
         print(e)
         help()
@@ -0,0 +1,156 @@
+import itertools
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import httpclient
+
+#Upper bounds (ms) of the latency histogram buckets, the last bucket takes everything slower
+HISTOGRAM_BOUNDS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+HISTOGRAM_WIDTH = 40
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def share(total: int, parts: int, index: int) -> int:
+    '''index's share when total is split as evenly as possible into parts.'''
+    return total // parts + (index < total % parts)
+
+def run_worker(method: str, url: str, args: list, requests: int, concurrency: int, duration: float) -> dict:
+    '''Sends requests from concurrency threads sharing one HTTPClient, until requests have been
+    sent or duration seconds have passed, whichever comes first. None means no such limit.'''
+    client = httpclient.HTTPClient(max_per_host = concurrency, max_idle = concurrency)
+    #count() hands out each number once even across threads, so exactly requests get sent
+    tickets = itertools.count()
+    deadline = time.monotonic() + duration if duration is not None else None
+
+    def loop() -> dict:
+        latencies = []
+        codes = Counter()
+        errors = Counter()
+        received = 0
+        while (requests is None or next(tickets) < requests) and (deadline is None or time.monotonic() < deadline):
+            start = time.perf_counter()
+            try:
+                response = client.command(method, url, args)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            codes[response.code] += 1
+            if response.timing is not None:
+                received += response.timing.bytes_received
+        return {'latencies': latencies, 'codes': codes, 'errors': errors, 'bytes_received': received}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda i: loop(), range(concurrency)))
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    result = merge(results)
+    result['seconds'] = elapsed
+    return result
+
+def merge(results: list) -> dict:
+    '''Combines the results of several loops or workers, which ran side by side.'''
+    merged = {'latencies': [], 'codes': Counter(), 'errors': Counter(), 'bytes_received': 0, 'seconds': 0.0}
+    for result in results:
+        merged['latencies'] += result['latencies']
+        merged['codes'].update(result['codes'])
+        merged['errors'].update(result['errors'])
+        merged['bytes_received'] += result['bytes_received']
+        merged['seconds'] = max(merged['seconds'], result.get('seconds', 0.0))
+    return merged
+
+def _worker_process(queue, *args):
+    queue.put(run_worker(*args))
+
+def run(method: str, url: str, args: list = None, requests: int = None, concurrency: int = 1,
+        duration: float = None, processes: int = 1) -> dict:
+    '''Load-tests url with concurrency requests in flight at a time, spread over processes worker
+    processes so that the client isn't held to one core. Stops after requests requests or duration
+    seconds, whichever comes first. Returns the merged results, latencies sorted and in seconds.'''
+    if requests is None and duration is None:
+        raise ValueError('A request count or a duration is needed to know when to stop')
+    concurrency = max(1, concurrency)
+    processes = max(1, min(processes, concurrency))
+
+    if processes == 1:
+        result = run_worker(method, url, args, requests, concurrency, duration)
+    else:
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target = _worker_process,
+                                           args = (queue, method, url, args,
+                                                   None if requests is None else share(requests, processes, i),
+                                                   share(concurrency, processes, i), duration))
+                   for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        #Drained before joining, a child can't exit while its result is stuck in the pipe
+        result = merge([queue.get() for worker in workers])
+        for worker in workers:
+            worker.join()
+
+    result['latencies'].sort()
+    result['codes'] = dict(result['codes'])
+    result['errors'] = dict(result['errors'])
+    return result
+
+def histogram(latencies: list) -> list:
+    '''Returns (label, count) per bucket of HISTOGRAM_BOUNDS, trimmed to the buckets in use.'''
+    counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    bucket = 0
+    #latencies are sorted, so the buckets fill in order
+    for latency in latencies:
+        while bucket < len(HISTOGRAM_BOUNDS) and latency * 1000 > HISTOGRAM_BOUNDS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    labels = [f'<= {bound:g} ms' for bound in HISTOGRAM_BOUNDS] + [f'>  {HISTOGRAM_BOUNDS[-1]:g} ms']
+    used = [i for i, count in enumerate(counts) if count]
+    if not used:
+        return []
+    return list(zip(labels, counts))[used[0]:used[-1] + 1]
+
+def summary(result: dict) -> str:
+    '''Formats the results of run() in the manner of ab and wrk.'''
+    latencies = result['latencies']
+    completed = len(latencies)
+    failed = sum(result['errors'].values())
+    seconds = result['seconds'] or float('inf')
+    non_2xx = sum(count for code, count in result['codes'].items() if not 200 <= code < 300)
+
+    lines = [
+        f'Completed requests:   {completed}',
+        f'Failed requests:      {failed}',
+        f'Non-2xx responses:    {non_2xx}',
+        f'Time taken:           {result["seconds"]:.3f} s',
+        f'Requests per second:  {completed / seconds:.2f}',
+        f'Transfer rate:        {result["bytes_received"] / seconds / 1024:.2f} KiB/s received',
+    ]
+    if latencies:
+        lines.append('')
+        lines.append(f'Latency (ms)   min {latencies[0] * 1000:.2f}  mean {sum(latencies) / completed * 1000:.2f}'
+                     f'  max {latencies[-1] * 1000:.2f}')
+        lines.append('  ' + '  '.join(f'p{int(fraction * 100)} {percentile(latencies, fraction) * 1000:.2f}'
+                                      for fraction in (0.5, 0.75, 0.9, 0.99)))
+        lines.append('')
+        lines.append('Latency distribution')
+        buckets = histogram(latencies)
+        largest = max(count for label, count in buckets)
+        for label, count in buckets:
+            bar = '#' * round(count / largest * HISTOGRAM_WIDTH)
+            lines.append(f'  {label:<20} {count:>9}  {bar}')
+    if result['codes']:
+        lines.append('')
+        lines.append('Status codes')
+        for code, count in sorted(result['codes'].items()):
+            lines.append(f'  {code:<20} {count:>9}')
+    if result['errors']:
+        lines.append('')
+        lines.append('Errors')
+        for name, count in sorted(result['errors'].items()):
+            lines.append(f'  {name:<20} {count:>9}')
+    return '\n'.join(lines)
@@ -0,0 +1,319 @@
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from socketr import ResponseParser, HeadersComplete, InformationalResponse, BodyData
+
+MIN_READ_SIZE = 16 * 1024
+MAX_READ_SIZE = 1024 * 1024
+#Read size for response heads, which usually brings a small body along in the same read
+HEAD_READ_SIZE = 64 * 1024
+
+#select() can't watch descriptors past 1024, poll() has no such limit and no descriptor of its own to open
+_Selector = getattr(selectors, 'PollSelector', selectors.DefaultSelector)
+
+def wait_readable(sock: socket.socket, timeout: float) -> bool:
+    '''Whether sock turns readable (data or EOF) within timeout seconds.'''
+    with _Selector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        return bool(selector.select(timeout))
+
+class ConnectionClosed(ConnectionError):
+    '''The peer closed the connection before sending any part of a response.'''
+
+class HTTPTimeout(TimeoutError):
+    '''A request took longer than one of the client's timeouts allows.'''
+
+class ConnectTimeout(ConnectionError, HTTPTimeout):
+    '''No connection could be made within the connect timeout.'''
+
+class ReadTimeout(HTTPTimeout):
+    '''The peer went quiet for longer than the read timeout on an open connection.'''
+
+class DeadlineExceeded(HTTPTimeout):
+    '''The overall deadline of a request passed before it completed.'''
+
+class Connection(object):
+    '''A socket to a single (host, port) origin that can be reused across requests.'''
+
+    def __init__(self, sock: socket.socket, host: str, port: int, scheme: str = 'http'):
+        self.socket = sock
+        self.host = host
+        self.port = port
+        self.scheme = scheme
+        #Bytes read past the end of the last message, belonging to the next one
+        self.buffer = bytearray()
+        #Adaptive body read size, grown while the peer keeps filling whole reads
+        self.read_size = MIN_READ_SIZE
+        #Response heads are read here, small enough that body bytes read along with a head are cheap to copy
+        self._scratch = memoryview(bytearray(HEAD_READ_SIZE))
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0
+        #Running totals, and when the first byte of the current response arrived
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.first_byte_at = None
+        #Longest wait on any one socket operation (None for no limit), and when the current request must end
+        self.timeout = sock.gettimeout()
+        self.deadline = None
+
+    @property
+    def key(self) -> tuple:
+        return (self.scheme, self.host, self.port)
+
+    @property
+    def reused(self) -> bool:
+        return self.requests > 0
+
+    def is_stale(self) -> bool:
+        '''An idle socket that is readable has either been closed by the peer or received unsolicited data.'''
+        if self.socket.fileno() < 0:
+            return True
+        try:
+            readable = wait_readable(self.socket, 0)
+        except (OSError, ValueError):
+            return True
+        return readable or bool(self.buffer)
+
+    def set_deadline(self, deadline: float):
+        '''Bounds every following socket operation by deadline (a time.monotonic() value) until it
+        is set back to None, on top of the connection's own timeout.'''
+        if deadline is None and self.deadline is not None:
+            self.socket.settimeout(self.timeout)
+        self.deadline = deadline
+
+    def sendall(self, data: bytes):
+        if self.deadline is not None:
+            self._bound_wait()
+        try:
+            self.socket.sendall(data)
+        except socket.timeout:
+            raise self._timed_out() from None
+        self.bytes_sent += len(data)
+
+    def sendmsg(self, buffers: list):
+        '''Sends buffers back to back with gather writes (socket.sendmsg), so e.g a head and its body
+        go out together without first being copied into one. Short writes resume where they stopped.'''
+        if not hasattr(self.socket, 'sendmsg'):
+            for buffer in buffers:
+                self.sendall(buffer)
+            return
+        views = [view for view in (memoryview(buffer).cast('B') for buffer in buffers) if len(view)]
+        total = sum(len(view) for view in views)
+        try:
+            while views:
+                if self.deadline is not None:
+                    self._bound_wait()
+                sent = self.socket.sendmsg(views)
+                #Drop what went out, the first buffer not fully sent is trimmed to its unsent tail
+                while views and sent >= len(views[0]):
+                    sent -= len(views.pop(0))
+                if sent:
+                    views[0] = views[0][sent:]
+        except socket.timeout:
+            raise self._timed_out() from None
+        self.bytes_sent += total
+
+    def sendfile(self, file, count: int):
+        '''Sends count bytes of a regular file opened in binary mode, from its current position, with
+        os.sendfile where the platform has it, so the bytes go from the page cache to the socket
+        without passing through user space.'''
+        if self.deadline is not None:
+            self._bound_wait()
+        try:
+            sent = self.socket.sendfile(file, file.tell(), count)
+        except socket.timeout:
+            raise self._timed_out() from None
+        self.bytes_sent += sent
+        if sent < count:
+            raise OSError(f'File ended {count - sent} bytes short of its Content-Length')
+
+    def _recv_into(self, view) -> int:
+        '''A single socket read, subject to the timeout and deadline.'''
+        if self.deadline is not None:
+            self._bound_wait()
+        try:
+            count = self.socket.recv_into(view)
+        except socket.timeout:
+            raise self._timed_out() from None
+        if count and self.first_byte_at is None:
+            self.first_byte_at = time.monotonic()
+        self.bytes_received += count
+        return count
+
+    def _bound_wait(self):
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f'Deadline passed while talking to {self.host}:{self.port}')
+        self.socket.settimeout(remaining if self.timeout is None else min(self.timeout, remaining))
+
+    def _timed_out(self) -> HTTPTimeout:
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return DeadlineExceeded(f'Deadline passed while talking to {self.host}:{self.port}')
+        return ReadTimeout(f'{self.host}:{self.port} did not respond within {self.timeout}s')
+
+    def recv_into(self, view: memoryview) -> int:
+        '''Reads at most len(view) bytes, from the buffer if it holds any, otherwise with a single socket read.'''
+        if self.buffer:
+            received = min(len(view), len(self.buffer))
+            view[:received] = self.buffer[:received]
+            del self.buffer[:received]
+            return received
+        return self._recv_into(view)
+
+    def feed(self, parser: ResponseParser, view: memoryview = None) -> list:
+        '''Reads once into view (by default a scratch buffer) and returns the events of feeding it to parser.
+        Their BodyData points into view. Bytes past the end of the response go back to the buffer.
+        The peer closing before any part of a response raises ConnectionClosed.'''
+        scratch = view is None
+        if scratch:
+            view = self._scratch
+        try:
+            received = self.recv_into(view)
+        except ConnectionResetError:
+            if parser.started:
+                raise
+            received = 0
+        if received:
+            events = parser.feed(view[:received])
+        else:
+            events = parser.feed_eof()
+            if not events and not parser.done:
+                raise ConnectionClosed(f'{self.host}:{self.port} closed the connection without responding')
+        if parser.unconsumed:
+            self.buffer[:0] = parser.unconsumed
+            parser.unconsumed = b''
+        #Body reads that fill the space given double the next read size
+        if not scratch and received == len(view) and self.read_size < MAX_READ_SIZE:
+            self.read_size *= 2
+        return events
+
+    def read_head(self, parser: ResponseParser) -> tuple:
+        '''Feeds parser until the final response's head is in. Returns its HeadersComplete event and the
+        events that came after it in the same read, their BodyData copied out of the scratch buffer.'''
+        while True:
+            final = self._final_head(self.feed(parser))
+            if final is not None:
+                return final
+
+    def await_continue(self, parser: ResponseParser, timeout: float) -> tuple:
+        '''Waits up to timeout seconds for the answer to a head sent with Expect: 100-continue.
+        Returns None when the body should follow: a 100 (Continue) came, or nothing did in time.
+        A server that answered with a final status instead gets it returned as read_head would.'''
+        end = time.monotonic() + timeout
+        if self.deadline is not None:
+            end = min(end, self.deadline)
+        while True:
+            if not self.buffer:
+                remaining = end - time.monotonic()
+                if remaining <= 0 or not wait_readable(self.socket, remaining):
+                    return None
+            events = self.feed(parser)
+            final = self._final_head(events)
+            if final is not None:
+                return final
+            #Other interim responses (e.g 103 Early Hints) don't say to go ahead
+            if any(type(event) is InformationalResponse and event.code == 100 for event in events):
+                return None
+
+    @staticmethod
+    def _final_head(events: list) -> tuple:
+        for i, event in enumerate(events):
+            if type(event) is HeadersComplete:
+                rest = [BodyData(bytes(event.data)) if type(event) is BodyData else event
+                        for event in events[i + 1:]]
+                return (events[i], rest)
+        return None
+
+    def close(self):
+        self.socket.close()
+
+class ConnectionPool(object):
+    '''Keeps persistent connections per (host, port) so requests to the same origin skip the TCP handshake.
+
+    connect is a callable (host, port, timing, deadline, scheme) -> socket used to open new connections,
+    where timing and deadline are those of the request that needed it, or None, and scheme its url's.
+    max_per_host caps open connections (idle and checked out) to one origin; acquire blocks until one frees up.
+    max_idle caps how many idle connections are kept per origin, and idle_timeout how long (seconds) they are kept.
+    '''
+
+    def __init__(self, connect, max_per_host: int = 10, max_idle: int = 4, idle_timeout: float = 30.0):
+        self.connect = connect
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Condition()
+
+    def acquire(self, host: str, port: int, timing = None, deadline: float = None, scheme: str = 'http') -> Connection:
+        '''Checks out an idle connection to (host, port) for urls of scheme, or opens a new one.
+        Waiting for a free slot past deadline (a time.monotonic() value) raises DeadlineExceeded.'''
+        key = (scheme, host, port)
+        with self._lock:
+            while True:
+                conn = self._pop_idle(key)
+                if conn is not None:
+                    return conn
+                if self._open.get(key, 0) < self.max_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                if deadline is None:
+                    self._lock.wait()
+                elif not self._lock.wait(deadline - time.monotonic()):
+                    raise DeadlineExceeded(f'Deadline passed waiting for a connection to {host}:{port}')
+
+        try:
+            sock = self.connect(host, port, timing, deadline, scheme)
+        except BaseException:
+            self._forget(key)
+            raise
+        return Connection(sock, host, port, scheme)
+
+    def release(self, conn: Connection, reusable: bool = True):
+        '''Returns a checked out connection. Connections that cannot carry another request are closed.'''
+        conn.requests += 1
+        conn.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(conn.key, deque())
+            if reusable and len(idle) < self.max_idle:
+                idle.append(conn)
+                #Waiters for every origin share the condition, only a waiter for this one can use the connection
+                self._lock.notify_all()
+                return
+        self.discard(conn)
+
+    def discard(self, conn: Connection):
+        '''Closes a checked out connection and frees its slot.'''
+        conn.close()
+        self._forget(conn.key)
+
+    def close(self):
+        '''Closes every idle connection.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            for key, conns in idle.items():
+                self._open[key] -= len(conns)
+            self._lock.notify_all()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _pop_idle(self, key: tuple):
+        '''Returns the most recently used live idle connection for key, closing any dead ones. Caller holds the lock.'''
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used < self.idle_timeout and not conn.is_stale():
+                return conn
+            conn.close()
+            self._open[key] -= 1
+        return None
+
+    def _forget(self, key: tuple):
+        with self._lock:
+            self._open[key] -= 1
+            self._lock.notify_all()
@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+from urllib.parse import urljoin, urldefrag, urlparse
+
+#Status codes followed as redirects, and those among them that are permanent
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+PERMANENT_CODES = (301, 308)
+
+class TooManyRedirects(Exception):
+    '''A request was redirected more times than the client allows.'''
+
+#Schemes the client can follow a redirect to
+SCHEMES = ('http', 'http+unix')
+
+def redirect_target(url: str, code: int, location: str) -> str:
+    '''Returns the absolute url a response redirects to, or None if it isn't a redirect the client
+    can follow (no Location, or a scheme other than http and http+unix). An http+unix target is only
+    followed from the same socket, so a remote server can't point the client at local sockets.'''
+    if code not in REDIRECT_CODES or location is None:
+        return None
+    #urljoin only resolves relative references against schemes it knows
+    unix = url.startswith('http+unix://')
+    if unix:
+        url = 'http' + url[len('http+unix'):]
+    #Location may be relative to the url that was requested (RFC 7231 7.1.2), fragments stay client-side
+    target = urldefrag(urljoin(url, location.strip()))[0]
+    if unix and urlparse(target).netloc == urlparse(url).netloc and target.startswith('http://'):
+        target = 'http+unix' + target[len('http'):]
+    target_url = urlparse(target)
+    if target_url.scheme not in SCHEMES:
+        return None
+    if target_url.scheme == 'http+unix' and not (unix and target_url.netloc == urlparse(url).netloc):
+        return None
+    return target
+
+def redirected_request(code: int, method: str, args, body) -> tuple:
+    '''Returns the (method, args, body) to send to a redirect target (RFC 7231 6.4).
+    303 always becomes a GET, and so do POSTs redirected with 301/302, as every browser does.
+    Otherwise the method and body are kept. A GET's args were part of the original url's query,
+    so they are dropped either way.'''
+    if code == 303 or (code in (301, 302) and method == 'POST'):
+        return ('GET', None, None)
+    if method == 'GET':
+        return (method, None, body)
+    return (method, args, body)
+
+class RedirectCache(object):
+    '''Remembers permanent (301/308) redirects so later requests go straight to the target.
+    At most max_entries urls are kept, evicting the least recently used.'''
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.hits = 0
+        #url -> (code, target url), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, url: str) -> tuple:
+        '''Returns (code, target url) for a url known to redirect permanently, or None.'''
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                self.hits += 1
+            return entry
+
+    def store(self, url: str, code: int, target: str):
+        with self._lock:
+            self._entries[url] = (code, target)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'entries': len(self._entries)}
@@ -0,0 +1,56 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+class Resolver(object):
+    '''Caches getaddrinfo results per (host, port) so repeat requests skip the blocking lookup.
+
+    Entries live for ttl seconds and at most max_entries are kept, evicting the least recently used.
+    Both IPv4 and IPv6 addresses are returned, in the order getaddrinfo gives them.
+    getaddrinfo can be replaced (e.g by a stub in tests) with any callable of the same signature.
+    '''
+
+    def __init__(self, ttl: float = 60.0, max_entries: int = 256, getaddrinfo = socket.getaddrinfo):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.getaddrinfo = getaddrinfo
+        self.hits = 0
+        self.misses = 0
+        #(host, port) -> (expiry, addresses), least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host: str, port: int) -> list:
+        '''Returns (family, type, proto, canonname, sockaddr) tuples to try for (host, port).'''
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        #Looked up outside the lock so one slow name doesn't stall every other thread
+        addresses = self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            self._cache[key] = (now + self.ttl, addresses)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last = False)
+        return addresses
+
+    def invalidate(self, host: str, port: int):
+        '''Drops the cached addresses of (host, port), e.g after none of them could be reached.'''
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache)}
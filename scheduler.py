@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from urllib.parse import urlparse
+import httpclient
+
+class TokenBucket(object):
+    '''Lets requests through at rate per second on average, and up to burst at once after a quiet spell.'''
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        '''Seconds until a token is available, 0 if one is now.'''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class Job(object):
+    __slots__ = ('host', 'method', 'url', 'args', 'future', 'queued')
+
+    def __init__(self, host: str, method: str, url: str, args):
+        self.host = host
+        self.method = method
+        self.url = url
+        self.args = args
+        self.future = Future()
+        self.queued = time.monotonic()
+
+class HostStats(object):
+    '''What the scheduler has done for one host. wait_total and wait_max are seconds spent queued.'''
+    __slots__ = ('queued', 'in_flight', 'sent', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def to_dict(self) -> dict:
+        return {'queued': self.queued, 'in_flight': self.in_flight, 'sent': self.sent,
+                'wait_mean': self.wait_total / self.sent if self.sent else 0.0, 'wait_max': self.wait_max}
+
+class Scheduler(object):
+    '''Queues requests per host in front of HTTPClient.command and runs them on max_in_flight worker
+    threads, so at most that many are in flight overall and at most max_per_host to any one host.
+
+    Hosts with queued requests take turns (round-robin), and a host at its cap or out of tokens is
+    skipped rather than waited on, so one slow or rate-limited origin never holds up the others.
+    rates maps hosts (as in the url, e.g 'example.com:8080') to requests per second, and rate applies
+    to every other host, None for no limit. Up to burst requests may go out at once under a rate.
+    '''
+
+    def __init__(self, client: httpclient.HTTPClient = None, max_in_flight: int = 32, max_per_host: int = 8,
+                 rate: float = None, rates: dict = None, burst: float = 1.0):
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.client = client if client is not None else httpclient.HTTPClient(max_per_host, max_per_host)
+        self.rate = rate
+        self.rates = dict(rates or {})
+        self.burst = burst
+        #host -> queued Jobs, oldest first, and the hosts with queued jobs in the order they take turns
+        self._queues = {}
+        self._turns = deque()
+        self._stats = {}
+        self._buckets = {}
+        self._in_flight = 0
+        self._workers = []
+        self._closed = False
+        self._lock = threading.Condition()
+
+    def submit(self, method: str, url: str, args = None) -> Future:
+        '''Queues a request, returning a Future of its response.'''
+        host = urlparse(url).netloc
+        job = Job(host, method, url, args)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Scheduler is closed')
+            queue = self._queues.setdefault(host, deque())
+            if not queue:
+                self._turns.append(host)
+            queue.append(job)
+            self._host_stats(host).queued += 1
+            #Started as needed, up to the global cap
+            if len(self._workers) < self.max_in_flight and len(self._workers) < self._queued() + self._in_flight:
+                worker = threading.Thread(target = self._work, daemon = True)
+                self._workers.append(worker)
+                worker.start()
+            self._lock.notify()
+        return job.future
+
+    def close(self, wait: bool = True):
+        '''Stops taking requests. Queued ones still run; wait blocks until they have.'''
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        if wait:
+            for worker in list(self._workers):
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def stats(self) -> dict:
+        '''Per host queue depth, requests in flight and sent, and mean and longest queueing wait (seconds).'''
+        with self._lock:
+            return {host: stats.to_dict() for host, stats in self._stats.items()}
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _host_stats(self, host: str) -> HostStats:
+        stats = self._stats.get(host)
+        if stats is None:
+            stats = self._stats[host] = HostStats()
+        return stats
+
+    def _bucket(self, host: str) -> TokenBucket:
+        if host not in self._buckets:
+            rate = self.rates.get(host, self.rate)
+            self._buckets[host] = TokenBucket(rate, self.burst) if rate else None
+        return self._buckets[host]
+
+    def _next_job(self) -> tuple:
+        '''Takes the next job in round-robin order from a host under its cap and rate. Returns it, or None
+        and how long until a rate-limited host can go (None if only a finished request can free one up).
+        Caller holds the lock.'''
+        now = time.monotonic()
+        wait = None
+        for i in range(len(self._turns)):
+            host = self._turns[0]
+            #Whether it goes now or not, the next host is considered first next time
+            self._turns.rotate(-1)
+            stats = self._stats[host]
+            if stats.in_flight >= self.max_per_host:
+                continue
+            bucket = self._bucket(host)
+            if bucket is not None:
+                delay = bucket.delay(now)
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+
+            queue = self._queues[host]
+            job = None
+            while queue and job is None:
+                job = queue.popleft()
+                stats.queued -= 1
+                #Cancelled while queued
+                if not job.future.set_running_or_notify_cancel():
+                    job = None
+            if not queue:
+                self._turns.remove(host)
+            if job is None:
+                continue
+
+            if bucket is not None:
+                bucket.take()
+            waited = now - job.queued
+            stats.in_flight += 1
+            stats.sent += 1
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+            self._in_flight += 1
+            return (job, None)
+        return (None, wait)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while True:
+                    job, wait = self._next_job()
+                    if job is not None:
+                        break
+                    if self._closed and not self._turns:
+                        return
+                    self._lock.wait(wait)
+
+            try:
+                response = self.client.command(job.method, job.url, job.args)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(response)
+
+            with self._lock:
+                self._stats[job.host].in_flight -= 1
+                self._in_flight -= 1
+                #A slot just freed up, possibly for a host another worker is waiting to serve
+                self._lock.notify()
@@ -1,9 +1,25 @@
-from urllib.parse import urlparse
+import os
+import re
+import stat
+import time
+from io import UnsupportedOperation
+from urllib.parse import urlparse, urlencode
 from config import mapping
 from abc import ABC
 from email.utils import formatdate
 from headers import *
 
+def unfold(lines: list) -> list:
+    '''Joins obsolete folded header lines (starting with a space or tab) onto the line they continue,
+    with a single space, as ResponseParser does (RFC 7230 3.2.4).'''
+    unfolded = []
+    for line in lines:
+        if line[:1] in (' ', '\t') and unfolded:
+            unfolded[-1] = unfolded[-1].rstrip() + ' ' + line.strip()
+        else:
+            unfolded.append(line)
+    return unfolded
+
 class R(ABC):
     '''Parent class for Request and Response'''
     #Class attribute used to generalize the from_str method that both Request and Response use
@@ -18,12 +34,22 @@ class R(ABC):
     @classmethod
     def from_str(cls, data: str):
         header_strs, body = cls.hb_split(data)
+        return cls.from_lines(header_strs, body)
+
+    @classmethod
+    def from_head(cls, head: str, body: str):
+        '''Constructs R from a complete header block (including its blank line) and an already framed body.'''
+        return cls.from_lines(head[:-4].split('\r\n'), body)
+
+    @classmethod
+    def from_lines(cls, header_strs: list, body: str):
+        '''Constructs R from its initial header line, the remaining header lines and a body.'''
         headers = []
 
         intl_hdr_str = header_strs.pop(0)
         headers.append(cls.initial_header.from_str(intl_hdr_str))
 
-        for std_hdr_str in header_strs:
+        for std_hdr_str in unfold(header_strs):
             headers.append(StdHeader.from_str(std_hdr_str))
 
         return cls(headers, body)
@@ -32,7 +58,8 @@ class R(ABC):
     def hb_split(data: str) -> tuple:
         '''Splits an R into its header strings and body strings'''
 
-        data = data.split('\r\n\r\n')
+        #Only the first blank line ends the headers, the body may contain one too
+        data = data.split('\r\n\r\n', 1)
         headers = [header for header in data[0].split('\r\n')]
         #No body since terminator is \r\n
         try:
@@ -43,102 +70,588 @@ class R(ABC):
         return (headers, body)
 
     def __init__(self, headers = [], body = None):
+        #Ordered headers are kept for serialization, the index is for lookups
         self.headers = headers
         self.body = body
+        self._index = {}
+        for header in headers:
+            self._index_header(header)
+        #Serialized header block, filled in on first use
+        self._wire_head = None
+
+    def _index_header(self, header: Header):
+        #Fields are case-insensitive (RFC 7230 3.2), and may repeat (e.g Set-Cookie)
+        for field, value in header.to_dict().items():
+            self._index.setdefault(field.lower(), []).append(value)
+
+    def add_header(self, header: Header):
+        '''Appends a header, keeping the lookup index current.'''
+        self.headers.append(header)
+        self._index_header(header)
+        self._wire_head = None
+
+    @classmethod
+    def _prebuilt(cls, headers: list, body, index: dict, wire_head: bytes):
+        '''Constructs R from headers whose index and serialized form were already worked out.'''
+        r = cls.__new__(cls)
+        r.headers = headers
+        r.body = body
+        r._index = index
+        r._wire_head = wire_head
+        return r
+
+    def head(self) -> str:
+        '''Returns the initial line and headers, including the blank line that ends them.'''
+        return ''.join([str(header) for header in self.headers]) + '\r\n'
 
     def __str__(self):
         '''Returns an HTTP/1.1 compliant string-representation of an R, with headers and a body.'''
-        r_content = ''
-
-        for header in self.headers:
-            r_content += str(header)
-        #Header-body delimiter
-        r_content += '\r\n'
-        r_content += self.body
-        
-        return r_content
+        #Header-body delimiter is the empty line after the headers
+        return self.head() + self.body
 
     def encode(self, charset) -> bytes:
         return bytearray(self.__str__, charset)
     
     def get(self, field: str) -> str:
-        for header in self.headers:
-            #This inefficient method allows us to get attributes from the irregular headers
-            h_dict = header.to_dict()
-            if field.capitalize() in h_dict.keys():
-                return h_dict[field]
+        '''Returns the first value of field (case-insensitive), or None if absent.'''
+        values = self._index.get(field.lower())
+        return values[0] if values else None
 
-        return None
+    def get_all(self, field: str) -> list:
+        '''Returns every value of a repeated field, in order.'''
+        return list(self._index.get(field.lower(), ()))
+
+    def __contains__(self, field: str) -> bool:
+        return field.lower() in self._index
     
 class Request(R):
     initial_header = IntlReqHeader
+    #Scheme of the url the request was built from, which picks the transport it goes out on
+    url_scheme = 'http'
 
     def __init__(self, headers: list, body: str):
         super().__init__(headers, body)
 
     @classmethod
-    def from_args(cls, method, url, args):
-        '''Constructs a request from a CLI input.'''
+    def from_args(cls, method, url, args, body = None):
+        '''Constructs a request from a CLI input.
+        body, if given, replaces the form body built from the query and args. It may be bytes-like,
+        a file object or an iterable of byte chunks; when its length can't be known up front it is
+        sent with chunked transfer encoding.'''
 
         #Break url into elementary components
         url = urlparse(url)
-        body = cls._get_body(url, args)
-        headers = cls._get_headers(method, url, body)
+        if body is None:
+            body = cls._get_body(url, args)
+            content_type = mapping['Content-Type']
+        else:
+            content_type = 'application/octet-stream'
+        headers = cls._get_headers(method, url, cls.body_length(body), content_type)
 
-        return cls(headers, body)
+        request = cls(headers, body)
+        request.url_scheme = url.scheme.lower()
+        return request
+
+    @staticmethod
+    def body_length(body) -> int:
+        '''Returns the encoded length of body, or None if only reading it would tell.'''
+        if isinstance(body, str):
+            return len(body.encode('utf-8'))
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            return memoryview(body).nbytes
+        if hasattr(body, 'fileno'):
+            try:
+                status = os.fstat(body.fileno())
+            except (OSError, ValueError, UnsupportedOperation):
+                return None
+            #Pipes and sockets have no meaningful size
+            if stat.S_ISREG(status.st_mode):
+                return status.st_size - body.tell()
+        return None
+
+    def head_bytes(self) -> bytes:
+        '''Returns head() encoded for the wire, cached after the first call.'''
+        if self._wire_head is None:
+            self._wire_head = self.head().encode('utf-8')
+        return self._wire_head
+
+    @property
+    def replayable(self) -> bool:
+        '''Whether the body can be sent again, e.g on a retry.'''
+        return isinstance(self.body, (str, bytes, bytearray, memoryview))
 
     @classmethod
     def _get_body(cls, url: tuple, args: object) -> str:
         '''Helper method to construct a request body from CLI'''
         #Format: Query (if any) + Args (if any)
+        parts = [url.query] if url.query != '' else []
 
-        #If there is no query it will be an empty string
-        body = url.query
-        body += '&' if body != '' else ''
-
-        if type(args) is dict:
+        if type(args) is dict and args:
             #Unit tests pass in dict, while CLI passes in a list (or None)
-            for i, (key, value) in enumerate(args.items(), start = 1):
-                body += f'{key}={value}'
-                if i < len(args):
-                    body += '&'
+            parts.append(urlencode(args))
         elif type(args) is list:
-            for i, arg in enumerate(args, start = 1):
-                body += arg
-                if i < len(args):
-                    body += '&'
+            #CLI args are already key=value pairs
+            parts.extend(args)
 
-        return body
+        return '&'.join(parts)
 
     @classmethod
-    def _get_headers(cls, method: str, url: tuple, body: str) -> list:
+    def _get_headers(cls, method: str, url: tuple, body_length: int, content_type: str) -> list:
         '''Helper method to construct request headers from CLI'''
 
         #Some servers like slashdot won't fill this in for us
         path = url.path if url.path != '' else '/'
         date = f'{formatdate(timeval = None, localtime = False, usegmt = False)}'
-        #According to unit tests, even empty POST requests have a content-length header
-        body_length = str(len(body))
 
         #Initial Headers (dynamic)
         headers = [
             IntlReqHeader(method, path, 'HTTP/1.1'),
             StdHeader('Host', url.netloc),
             StdHeader('Date', date),
-            StdHeader('Content-Length', body_length)
         ]
+        #According to unit tests, even empty POST requests have a content-length header
+        if body_length is None:
+            headers.append(StdHeader('Transfer-Encoding', 'chunked'))
+        else:
+            headers.append(StdHeader('Content-Length', str(body_length)))
 
         #All static headers based on config file
         for field, value in mapping.items():
             #Ignore Content-Type header if not a POST
-            if field == 'Content-Type' and method.upper() != 'POST':
+            if field == 'Content-Type':
+                if method.upper() == 'POST':
+                    headers.append(StdHeader(field, content_type))
                 continue
             headers.append(StdHeader(field, value))
 
         return headers
 
 class Response(R):
+    '''A response, whose header block may be kept as received and parsed only once a header is looked at.
+    The status line fields (Scheme, Code, Response) can be read without parsing the rest.'''
     initial_header = IntlResHeader
+    status_fields = ('scheme', 'code', 'response')
 
-    def __init__(self, headers: list, body: str):
-        super().__init__(headers, body)
\ No newline at end of file
+    def __init__(self, headers: list = None, body: str = None, raw_head: str = None):
+        #Received header block, blank line included, while it is the authoritative form of the headers
+        self._raw_head = raw_head
+        self._status = None
+        if raw_head is None:
+            super().__init__(headers, body)
+        else:
+            self._headers = None
+            self._fields = None
+            self.body = body
+            self._wire_head = None
+
+    @classmethod
+    def from_head(cls, head: str, body: str):
+        return cls(None, body, head)
+
+    @classmethod
+    def from_str(cls, data: str):
+        #Only the first blank line ends the head, the body may have blank lines of its own
+        head, _, body = data.partition('\r\n\r\n')
+        return cls(None, body, head + '\r\n\r\n')
+
+    @property
+    def headers(self) -> list:
+        if self._headers is None:
+            self._parse()
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers: list):
+        self._headers = headers
+
+    @property
+    def _index(self) -> dict:
+        if self._headers is None:
+            self._parse()
+        return self._fields
+
+    @_index.setter
+    def _index(self, index: dict):
+        self._fields = index
+
+    def _parse(self):
+        status = self._status_header()
+        headers = [status]
+        fields = {field.lower(): [value] for field, value in status.to_dict().items()}
+        #Same as StdHeader.from_str and _index_header, without a dict per line
+        for line in unfold(self._raw_head[:-4].split('\r\n')[1:]):
+            field, colon, value = line.partition(':')
+            if not colon:
+                raise ValueError(f'Malformed header line {line!r}')
+            field, value = field.strip(), value.strip()
+            headers.append(StdHeader(field, value))
+            fields.setdefault(field.lower(), []).append(value)
+        self._headers = headers
+        self._fields = fields
+
+    def _status_header(self) -> IntlResHeader:
+        if self._headers is not None:
+            return self._headers[0]
+        if self._status is None:
+            self._status = IntlResHeader.from_str(self._raw_head[:self._raw_head.find('\r\n')])
+        return self._status
+
+    def get(self, field: str) -> str:
+        field = field.lower()
+        if self._headers is None and field in self.status_fields:
+            return getattr(self._status_header(), field)
+        return super().get(field)
+
+    def add_header(self, header: Header):
+        super().add_header(header)
+        self._raw_head = None
+
+    def head(self) -> str:
+        if self._raw_head is not None:
+            return self._raw_head
+        return super().head()
+
+class RequestSerializer(object):
+    '''Builds requests the way Request.from_args does, for a client sending many of them.
+
+    The static headers from config.mapping are created and serialized once, and the Date header
+    once per second, so each request only formats its request line, Host and body length in front
+    of the cached block.
+    '''
+
+    def __init__(self):
+        #Content-Type (None when not a POST) -> (headers, index, wire bytes)
+        self._static = {}
+        self._date_second = None
+        self._date = None
+
+    def build(self, method: str, url: str, args, body = None) -> Request:
+        '''Same arguments and wire format as Request.from_args.'''
+        url = urlparse(url)
+        if body is None:
+            body = Request._get_body(url, args)
+            content_type = mapping['Content-Type']
+        else:
+            content_type = 'application/octet-stream'
+        if method.upper() != 'POST':
+            content_type = None
+        body_length = Request.body_length(body)
+
+        path = url.path if url.path != '' else '/'
+        initial = IntlReqHeader(method, path, 'HTTP/1.1')
+        host = StdHeader('Host', url.netloc)
+        date = self._date_header()
+        if body_length is None:
+            framing = StdHeader('Transfer-Encoding', 'chunked')
+        else:
+            framing = StdHeader('Content-Length', str(body_length))
+        headers = [initial, host, date, framing]
+
+        static_headers, static_index, static_wire = self._static_block(content_type)
+        index = {field: list(values) for field, values in static_index.items()}
+        index.update({
+            'method': [initial.method], 'path': [path], 'scheme': ['HTTP/1.1'],
+            'host': [host.value], 'date': [date.value], framing.field.lower(): [framing.value],
+        })
+        wire = f'{initial}{host}{date}{framing}'.encode('utf-8') + static_wire
+
+        request = Request._prebuilt(headers + static_headers, body, index, wire)
+        request.url_scheme = url.scheme.lower()
+        return request
+
+    def _date_header(self) -> StdHeader:
+        now = int(time.time())
+        if now != self._date_second:
+            self._date_second = now
+            self._date = StdHeader('Date', formatdate(timeval = now, localtime = False, usegmt = False))
+        return self._date
+
+    def _static_block(self, content_type: str) -> tuple:
+        if content_type not in self._static:
+            headers = []
+            for field, value in mapping.items():
+                if field == 'Content-Type':
+                    if content_type is not None:
+                        headers.append(StdHeader(field, content_type))
+                    continue
+                headers.append(StdHeader(field, value))
+            index = {}
+            for header in headers:
+                index.setdefault(header.field.lower(), []).append(header.value)
+            #The blank line ending the header block comes last, after the static headers
+            wire = (''.join([str(header) for header in headers]) + '\r\n').encode('utf-8')
+            self._static[content_type] = (headers, index, wire)
+        return self._static[content_type]
+
+class ProtocolError(ValueError):
+    '''Bytes received could not be parsed as an HTTP/1.1 response.'''
+
+class Event(object):
+    '''Something ResponseParser found in the bytes fed to it.'''
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+class StatusLine(Event):
+    __slots__ = ('version', 'code', 'reason')
+
+    def __init__(self, version: bytes, code: int, reason: bytes):
+        self.version = version
+        self.code = code
+        self.reason = reason
+
+class HeaderField(Event):
+    __slots__ = ('field', 'value')
+
+    def __init__(self, field: bytes, value: bytes):
+        self.field = field
+        self.value = value
+
+class InformationalResponse(Event):
+    '''End of an interim 1xx response's head. The final response follows it.'''
+    __slots__ = ('code', 'head')
+
+    def __init__(self, code: int, head: bytes):
+        self.code = code
+        self.head = head
+
+class HeadersComplete(Event):
+    '''End of the final response's head. framing is one of 'none', 'chunked', 'length' or 'eof',
+    length the Content-Length if any, and reusable whether the connection can carry another request.'''
+    __slots__ = ('head', 'framing', 'length', 'reusable')
+
+    def __init__(self, head: bytes, framing: str, length: int, reusable: bool):
+        self.head = head
+        self.framing = framing
+        self.length = length
+        self.reusable = reusable
+
+class BodyData(Event):
+    '''Part of the body, with any chunk framing removed. data is a memoryview into the fed buffer.'''
+    __slots__ = ('data',)
+
+    def __init__(self, data: memoryview):
+        self.data = data
+
+class EndOfMessage(Event):
+    __slots__ = ()
+
+#ResponseParser states
+HEAD, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, UNTIL_EOF, DONE = range(8)
+
+#Header fields that decide how a body is framed
+FRAMING_FIELDS = (b'transfer-encoding', b'content-length', b'connection')
+
+_BLANK_LINE = re.compile(b'\r\n\r\n')
+_LINE_END = re.compile(b'\n')
+
+def body_framing(version: bytes, code: int, fields: dict, method: str) -> tuple:
+    '''Decides how the body after a response head is delimited (RFC 7230 3.3.3), from its lower-cased
+    framing fields. Returns one of 'none', 'chunked', 'length' or 'eof', the Content-Length if any,
+    and whether the connection can carry another request afterwards.'''
+    connection = fields.get(b'connection')
+    if connection is None:
+        reusable = version != b'HTTP/1.0'
+    elif version == b'HTTP/1.0':
+        reusable = b'keep-alive' in connection.lower()
+    else:
+        reusable = b'close' not in connection.lower()
+
+    if code == 101:
+        #Whatever follows is another protocol
+        return ('none', 0, False)
+    if method == 'HEAD' or 100 <= code < 200 or code in (204, 304):
+        return ('none', 0, reusable)
+    if b'transfer-encoding' in fields and b'chunked' in fields[b'transfer-encoding'].lower():
+        return ('chunked', None, reusable)
+    length = fields.get(b'content-length')
+    if length is not None:
+        if not length.isdigit():
+            #Repeated fields were joined with commas, they must all agree
+            lengths = {value.strip() for value in length.split(b',')}
+            if len(lengths) != 1 or not next(iter(lengths)).isdigit():
+                raise ProtocolError(f'Invalid Content-Length {length!r}')
+            length = lengths.pop()
+        return ('length', int(length), reusable)
+    #No framing, the message ends when the server closes
+    return ('eof', None, False)
+
+class ResponseParser(object):
+    '''Push parser for one HTTP/1.1 response that does no I/O of its own.
+
+    feed() takes the response's bytes as they arrive, split anywhere, and returns the events they
+    complete: StatusLine, a HeaderField per line, HeadersComplete, BodyData and EndOfMessage.
+    An interim 1xx response comes as StatusLine, HeaderFields and InformationalResponse before the
+    final one. Nothing is decoded, and BodyData points into the fed buffer without copying it, so it
+    is only valid until that buffer is reused. Bytes fed past the end of the response (e.g the next
+    pipelined one) are kept in unconsumed. method is that of the request, as HEAD responses have no body.
+    '''
+
+    def __init__(self, method: str = 'GET', max_head: int = 64 * 1024):
+        self.method = method
+        #Longest head, or chunk size or trailer line, accepted
+        self.max_head = max_head
+        self.state = HEAD
+        self.started = False
+        self.framing = None
+        self.length = None
+        self.reusable = None
+        #Bytes left in the body ('length') or current chunk ('chunked')
+        self.remaining = 0
+        self.unconsumed = b''
+        self._head = bytearray()
+        self._line = bytearray()
+
+    @property
+    def done(self) -> bool:
+        return self.state == DONE
+
+    def feed(self, data) -> list:
+        '''Parses data, any bytes-like object, returning the events it completes.'''
+        view = memoryview(data)
+        end = len(view)
+        pos = 0
+        events = []
+        if end:
+            self.started = True
+        while pos < end:
+            state = self.state
+            if state == BODY or state == CHUNK_DATA:
+                count = min(self.remaining, end - pos)
+                events.append(BodyData(view[pos:pos + count]))
+                pos += count
+                self.remaining -= count
+                if not self.remaining:
+                    if state == BODY:
+                        self._end(events)
+                    else:
+                        self.state = CHUNK_END
+            elif state == UNTIL_EOF:
+                events.append(BodyData(view[pos:]))
+                pos = end
+            elif state == HEAD:
+                pos = self._feed_head(view, pos, events)
+            elif state == DONE:
+                self.unconsumed += view[pos:]
+                pos = end
+            else:
+                pos = self._feed_line(view, pos, events)
+        return events
+
+    def feed_eof(self) -> list:
+        '''Tells the parser the peer closed the connection. Returns the EndOfMessage of a body read to EOF,
+        or no events if the response is complete or never began. A response cut short raises ConnectionError.'''
+        if self.state == UNTIL_EOF:
+            events = []
+            self._end(events)
+            return events
+        if self.state == DONE or not self.started:
+            return []
+        if self.state == HEAD:
+            raise ConnectionError('Connection closed while reading response headers')
+        raise ConnectionError('Connection closed before the end of the body')
+
+    def _end(self, events: list):
+        events.append(EndOfMessage())
+        self.state = DONE
+
+    def _feed_head(self, view: memoryview, pos: int, events: list) -> int:
+        head = self._head
+        found = None
+        if head:
+            #The blank line may straddle the previous feed
+            tail = bytes(head[-3:]) + bytes(view[pos:pos + 3])
+            index = tail.find(b'\r\n\r\n')
+            if index >= 0:
+                found = pos + index + 4 - min(3, len(head))
+        if found is None:
+            match = _BLANK_LINE.search(view, pos)
+            if match is None:
+                head += view[pos:]
+                if len(head) > self.max_head:
+                    raise ProtocolError(f'Response head longer than {self.max_head} bytes')
+                return len(view)
+            found = match.end()
+        head += view[pos:found]
+        self._head = bytearray()
+        self._parse_head(bytes(head), events)
+        return found
+
+    def _parse_head(self, head: bytes, events: list):
+        lines = head[:-4].split(b'\r\n')
+        status = lines[0].split(b' ', 2)
+        if len(status) < 2 or not status[0].startswith(b'HTTP/') or len(status[1]) != 3 or not status[1].isdigit():
+            raise ProtocolError(f'Malformed status line {lines[0]!r}')
+        version, code = status[0], int(status[1])
+        events.append(StatusLine(version, code, status[2] if len(status) > 2 else b''))
+
+        fields = {}
+        for line in lines[1:]:
+            if line[0] in (32, 9) and type(events[-1]) is HeaderField:
+                #Obsolete line folding continues the previous value (RFC 7230 3.2.4)
+                events[-1].value += b' ' + line.strip()
+                continue
+            field, colon, value = line.partition(b':')
+            if not colon:
+                raise ProtocolError(f'Malformed header line {line!r}')
+            field, value = field.strip(), value.strip()
+            events.append(HeaderField(field, value))
+            lower = field.lower()
+            if lower in FRAMING_FIELDS:
+                fields[lower] = fields[lower] + b', ' + value if lower in fields else value
+
+        if 100 <= code < 200 and code != 101:
+            events.append(InformationalResponse(code, head))
+            return
+        self.framing, self.length, self.reusable = body_framing(version, code, fields, self.method)
+        events.append(HeadersComplete(head, self.framing, self.length, self.reusable))
+        if self.framing == 'chunked':
+            self.state = CHUNK_SIZE
+        elif self.framing == 'eof':
+            self.state = UNTIL_EOF
+        elif self.length:
+            self.state = BODY
+            self.remaining = self.length
+        else:
+            self._end(events)
+
+    def _feed_line(self, view: memoryview, pos: int, events: list) -> int:
+        '''Takes a chunk size, chunk terminator or trailer line, which may arrive over several feeds.'''
+        match = _LINE_END.search(view, pos)
+        if match is None:
+            self._line += view[pos:]
+            if len(self._line) > self.max_head:
+                raise ProtocolError('Chunk framing line too long')
+            return len(view)
+        end = match.end()
+        if self._line:
+            self._line += view[pos:end]
+            line = bytes(self._line)
+            self._line = bytearray()
+        else:
+            line = bytes(view[pos:end])
+        if not line.endswith(b'\r\n'):
+            raise ProtocolError(f'Bare line feed in chunk framing {line!r}')
+
+        if self.state == CHUNK_SIZE:
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                size = -1
+            if size < 0:
+                raise ProtocolError(f'Malformed chunk size line {line!r}')
+            if size:
+                self.state = CHUNK_DATA
+                self.remaining = size
+            else:
+                #Trailers follow the last chunk, ending with an empty line
+                self.state = TRAILERS
+        elif self.state == CHUNK_END:
+            if line != b'\r\n':
+                raise ProtocolError('Malformed chunk terminator')
+            self.state = CHUNK_SIZE
+        elif line == b'\r\n':
+            self._end(events)
+        return end
@@ -0,0 +1,148 @@
+import time
+from pool import Connection, ConnectionPool
+from socketr import ResponseParser, BodyData
+
+#Chunk size used when iterating or saving a body
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class BodyStream(object):
+    '''File-like view of a response body that is read off its connection on demand.
+
+    Only one chunk is held at a time, so memory stays flat regardless of body size.
+    The connection goes back to the pool once the body has been read to the end;
+    closing the stream early discards it instead, since it is mid-message.
+    A Timing passed in gets its last byte and the body's bytes once the end is reached.
+    '''
+
+    def __init__(self, conn: Connection, parser: ResponseParser, events: list, pool: ConnectionPool,
+                 decoder = None, timing = None):
+        self.conn = conn
+        #Parser that read the head, and the body events that arrived with it
+        self.parser = parser
+        self.framing = parser.framing
+        self.pool = pool
+        self.reusable = parser.reusable
+        self.done = False
+        #Undoes the Content-Encoding as the body is read, None to hand out the bytes as sent
+        self.decoder = decoder
+        self.timing = timing
+        self._received_mark = conn.bytes_received
+        self._pending = bytearray(b''.join([event.data for event in events if type(event) is BodyData]))
+        self._raw = bytearray()
+        self._decoded = bytearray()
+        self._flushed = False
+        if parser.done and not self._pending:
+            self._finish()
+
+    def readinto(self, buffer) -> int:
+        '''Reads at most len(buffer) bytes into buffer, returning how many. 0 means the body is over.'''
+        if self.decoder is None:
+            return self._read_raw_into(buffer)
+
+        if len(self._raw) < len(buffer):
+            self._raw = bytearray(len(buffer))
+        while not self._decoded and not self._flushed:
+            #Decoded no more than asked for at a time, a well compressed read may take several calls
+            if self.decoder.pending:
+                self._decoded += self.decoder.decompress(b'', len(buffer))
+                continue
+            received = self._read_raw_into(self._raw)
+            if received:
+                self._decoded += self.decoder.decompress(memoryview(self._raw)[:received], len(buffer))
+            else:
+                self._decoded += self.decoder.flush()
+                self._flushed = True
+        received = min(len(buffer), len(self._decoded))
+        with memoryview(buffer) as view:
+            view[:received] = self._decoded[:received]
+        del self._decoded[:received]
+        return received
+
+    def _read_raw_into(self, buffer) -> int:
+        if self.done or not len(buffer):
+            return 0
+        with memoryview(buffer) as view:
+            if self._pending:
+                received = min(len(view), len(self._pending))
+                view[:received] = self._pending[:received]
+                del self._pending[:received]
+            else:
+                received = self._recv_into(view)
+        if self.parser.done and not self._pending:
+            self._finish()
+        return received
+
+    def _recv_into(self, view: memoryview) -> int:
+        '''Reads off the connection until some body bytes land at the start of view, or the body ends.'''
+        parser = self.parser
+        while not parser.done:
+            region = view[:parser.remaining] if parser.framing == 'length' else view
+            try:
+                events = self.conn.feed(parser, region)
+            except BaseException:
+                self.close()
+                raise
+            received = 0
+            for event in events:
+                if type(event) is BodyData:
+                    count = len(event.data)
+                    #Chunked bodies come in pieces between their framing, moved down to close the gaps
+                    if parser.framing == 'chunked':
+                        view[received:received + count] = event.data
+                    received += count
+            if received:
+                return received
+        return 0
+
+    def read(self, size: int = -1) -> bytes:
+        '''Reads up to size bytes, or the rest of the body if size is negative.'''
+        if size < 0:
+            return b''.join(self)
+        data = bytearray(size)
+        received = self.readinto(data)
+        del data[received:]
+        return bytes(data)
+
+    def iter_chunks(self, chunk_size: int = STREAM_CHUNK_SIZE):
+        '''Yields the body as byte chunks of at most chunk_size.'''
+        buffer = bytearray(chunk_size)
+        with memoryview(buffer) as view:
+            while True:
+                received = self.readinto(view)
+                if not received:
+                    return
+                yield bytes(view[:received])
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def save(self, path: str, chunk_size: int = STREAM_CHUNK_SIZE) -> int:
+        '''Writes the rest of the body to path through one reused buffer. Returns the bytes written.'''
+        written = 0
+        buffer = bytearray(chunk_size)
+        with memoryview(buffer) as view, open(path, 'wb') as f:
+            while True:
+                received = self.readinto(view)
+                if not received:
+                    return written
+                f.write(view[:received])
+                written += received
+
+    def close(self):
+        '''Stops reading. A partially read body leaves its connection unusable, so it is discarded.'''
+        if not self.done:
+            self.done = True
+            self.pool.discard(self.conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _finish(self):
+        self.done = True
+        if self.timing is not None:
+            self.timing.last_byte = time.monotonic()
+            self.timing.bytes_received += self.conn.bytes_received - self._received_mark
+        self.pool.release(self.conn, self.reusable)
@@ -0,0 +1,40 @@
+import time
+
+class Timing(object):
+    '''Where the time of one request went, as time.monotonic() timestamps, plus the bytes it moved.
+
+    resolve_start, resolve_end and connect_end stay None when a pooled connection was reused,
+    and last_byte stays None until a streamed body has been read to the end.
+    '''
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.resolve_start = None
+        self.resolve_end = None
+        self.connect_end = None
+        self.request_sent = None
+        self.first_byte = None
+        self.last_byte = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.reused = False
+
+    def durations(self) -> dict:
+        '''Seconds spent in each phase, None for phases that didn't happen (yet).'''
+        def between(start, end):
+            return end - start if start is not None and end is not None else None
+
+        ready = self.connect_end if self.connect_end is not None else self.start
+        return {
+            'resolve': between(self.resolve_start, self.resolve_end),
+            'connect': between(self.resolve_end, self.connect_end),
+            'send': between(ready, self.request_sent),
+            'wait': between(self.request_sent, self.first_byte),
+            'download': between(self.first_byte, self.last_byte),
+            'total': between(self.start, self.last_byte),
+        }
+
+    def __repr__(self):
+        phases = ', '.join(f'{phase}={value * 1000:.2f}ms' for phase, value in self.durations().items()
+                           if value is not None)
+        return f'Timing({phases}, sent={self.bytes_sent}, received={self.bytes_received})'
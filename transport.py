@@ -0,0 +1,120 @@
+from abc import ABC, abstractmethod
+import socket
+import threading
+import time
+from pool import ConnectTimeout, DeadlineExceeded
+from resolver import Resolver
+
+def remaining_timeout(timeout: float, deadline: float) -> float:
+    '''timeout, shortened to what is left before deadline (a time.monotonic() value).'''
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline passed')
+    return remaining if timeout is None else min(timeout, remaining)
+
+class Transport(ABC):
+    '''How HTTPClient reaches an origin. connect returns a connected stream socket, which the
+    connection pool then sends requests on and reads responses from.'''
+
+    @abstractmethod
+    def connect(self, host, port, timeout: float = None, deadline: float = None, timing = None) -> socket.socket:
+        '''Opens a stream to (host, port), giving up after timeout seconds or once deadline passes.
+        Raises ConnectTimeout, DeadlineExceeded or ConnectionError. Resolve times go on timing, if given.'''
+        pass
+
+class TCPTransport(Transport):
+    '''TCP over IPv4 or IPv6, trying each address host resolves to in turn, each for up to timeout.'''
+
+    def __init__(self, resolver: Resolver = None):
+        #Cached name resolution, replaceable with a stub to run offline
+        self.resolver = resolver if resolver is not None else Resolver()
+
+    def connect(self, host, port, timeout: float = None, deadline: float = None, timing = None) -> socket.socket:
+        error = None
+        if timing is not None:
+            timing.resolve_start = time.monotonic()
+        try:
+            addresses = self.resolver.resolve(host, port)
+        except OSError as e:
+            addresses, error = [], e
+        if timing is not None:
+            timing.resolve_end = time.monotonic()
+
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            #Worked out first, socket.timeout would also catch the DeadlineExceeded it may raise
+            address_timeout = remaining_timeout(timeout, deadline)
+            sock = socket.socket(family, socktype, proto)
+            try:
+                #Small writes (heads, short bodies) go out at once rather than waiting on an ACK under Nagle's algorithm
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(address_timeout)
+                sock.connect(sockaddr)
+            except socket.timeout:
+                sock.close()
+                error = ConnectTimeout(f'Connecting to {sockaddr[0]} port {sockaddr[1]} timed out')
+                continue
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            return sock
+
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded(f'Deadline passed while connecting to {host}:{port}') from error
+        if isinstance(error, ConnectTimeout):
+            raise ConnectTimeout(f'Connection to {host}:{port} timed out.') from error
+        #The cached addresses may be out of date, look them up again next time
+        self.resolver.invalidate(host, port)
+        #Raised rather than exiting so one bad origin doesn't take down other requests
+        raise ConnectionError(f'Connection to {host}:{port} could not be made.') from error
+
+class UnixTransport(Transport):
+    '''Unix domain sockets, for servers on the same host. host is the socket's path and port is unused.'''
+
+    def connect(self, host, port, timeout: float = None, deadline: float = None, timing = None) -> socket.socket:
+        timeout = remaining_timeout(timeout, deadline)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(host)
+        except socket.timeout:
+            sock.close()
+            raise ConnectTimeout(f'Connection to {host} timed out.') from None
+        except OSError as e:
+            sock.close()
+            raise ConnectionError(f'Connection to {host} could not be made.') from e
+        return sock
+
+class LoopbackTransport(Transport):
+    '''Serves every connection in-process, e.g for tests: connect makes a socket pair and runs handler
+    on the far end in a thread. handler is a socketserver request handler class, such as a
+    http.server.BaseHTTPRequestHandler subclass, and is called as handler(sock, (host, port), transport).'''
+
+    def __init__(self, handler):
+        self.handler = handler
+        #Connections opened so far
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def connect(self, host, port, timeout: float = None, deadline: float = None, timing = None) -> socket.socket:
+        remaining_timeout(timeout, deadline)
+        client, server = socket.socketpair()
+        with self._lock:
+            self.connections += 1
+        threading.Thread(target = self._serve, args = (server, (host, port)), daemon = True).start()
+        return client
+
+    def _serve(self, sock: socket.socket, address: tuple):
+        try:
+            self.handler(sock, address, self)
+        except OSError:
+            #The client hung up first
+            pass
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            sock.close()